@@ -11,7 +11,7 @@ from flask import (
     )
 from flask_bootstrap import Bootstrap
 
-from app.lib import auth
+from app.lib import auth, images, serializer
 
 
 def create_app(config_filename=None):
@@ -55,6 +55,11 @@ def load_config(app, config_filename=None):
 def install_plugins(app):
     Bootstrap(app)
 
+    app.json = serializer.JSONProvider(app)
+
+    from app.database import close_db
+    app.teardown_appcontext(close_db)
+
     # kinda related?
     os.makedirs(os.path.join(app.config['DATA_DIRECTORY'], 'images', 'resized'), exist_ok=True)
 
@@ -84,7 +89,8 @@ def install_plugins(app):
     def image(v, size=None, class_=''):
         if not v:
             return
-        url = url_for('index.images', name=v)
+        mode = 'thumb' if size == 'xs' else images.DEFAULT_DERIVATIVE
+        url = url_for('index.images', name=v, mode=mode, v=images.image_version(v, mode))
         style = ''
         if size == 'xs':
             style = 'max-width: 50px; max-height: 50px;'
@@ -123,8 +129,14 @@ def register_blueprints(app):
 def register_commands(app):
     from app.commands import (
         queue as queue_commands,
+        db as db_commands,
+        bench as bench_commands,
+        images as images_commands,
     )
     app.cli.add_command(queue_commands.commands)
+    app.cli.add_command(db_commands.commands)
+    app.cli.add_command(bench_commands.commands)
+    app.cli.add_command(images_commands.commands)
 
 
 def install_error_handlers(app):
@@ -0,0 +1,162 @@
+import os
+import json
+import random
+import tempfile
+import time
+
+import click
+from flask.cli import AppGroup
+from marshmallow import fields
+from tinydb.table import Document
+
+from app import database
+from app.lib import serializer
+from app.storage.tinydb_backend import SerializerStorage
+from app.lib.printer import ReceiptTemplate, get_printer_config, get_printer_configs, have_printer_imports
+
+
+commands = AppGroup('bench')
+
+
+def _report(name, count, elapsed, unit):
+    click.echo(f"{name}: {count} {unit} in {elapsed:.3f}s, {elapsed / count * 1000:.3f}ms per {unit[:-1]} ({count / elapsed:.0f}/s)")
+
+
+@commands.command('receipt')
+@click.option('--tickets', default=200, help="Number of tickets to render")
+@click.option('--printer', 'printer_name', help="Printer whose format to use (default: the first one)")
+def bench_receipt(tickets, printer_name):
+    """Time rendering receipts with and without a compiled template."""
+    if not have_printer_imports:
+        raise click.ClickException("Printer libraries are not installed")
+    from escpos import printer
+    from PIL import Image
+
+    printer_config = get_printer_config(printer_name) if printer_name else get_printer_configs()[0]
+    if not printer_config:
+        raise click.ClickException("No such printer")
+    printer_config = dict(printer_config, image_impl=printer_config.get('image_impl') or 'bitImageRaster')
+
+    data = {
+        'name': 'Alice',
+        'drink_name': 'Cuba Libre [strong]',
+        'drink': None,
+        'drink_components': 'Rum, Coke, Lime',
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        logo = os.path.join(tmpdir, 'logo.png')
+        Image.new('RGB', (384, 128), (255, 255, 255)).save(logo)
+
+        # Compiling for each ticket does the same work print_order used to do per ticket
+        t = time.time()
+        for _ in range(tickets):
+            expected = ReceiptTemplate(printer_config).render(data, logo)
+        _report("Uncompiled", tickets, time.time() - t, 'tickets')
+
+        dummy = printer.Dummy()
+        t = time.time()
+        template = ReceiptTemplate(printer_config)
+        for _ in range(tickets):
+            buf = template.render(data, logo)
+            dummy._raw(buf)
+        _report("Compiled", tickets, time.time() - t, 'tickets')
+
+    if buf != expected:
+        raise click.ClickException("Compiled template output differs")
+    click.echo(f"{len(buf)} bytes per ticket, {len(dummy.output)} bytes sent to the dummy printer")
+
+
+def _sample_row(model):
+    values = {
+        fields.Str: 'Sample',
+        fields.Integer: 1,
+        fields.Float: 1.5,
+        fields.Boolean: True,
+        fields.List: [1, 2, 3],
+        fields.Dict: {'name': 'Sample'},
+        fields.DateTime: '2020-01-01T00:00:00',
+    }
+    row = {}
+    for name, field in model._get_schema().fields.items():
+        for type_, value in values.items():
+            if isinstance(field, type_):
+                row[name] = value
+                break
+        else:
+            raise click.ClickException(f"{model.__name__}.{name}: no sample value for {type(field).__name__}")
+    return Document(row, doc_id=1)
+
+
+@commands.command('hydrate')
+@click.option('--rows', default=20000, help="Number of rows to load per model")
+def bench_hydrate(rows):
+    """Time loading rows into models with Schema.load and with the generated hydrator."""
+    models = [
+        v for v in vars(database).values()
+        if isinstance(v, type) and issubclass(v, database.Model) and v is not database.Model
+    ]
+    for model in sorted(models, key=lambda m: m.__name__):
+        row = _sample_row(model)
+
+        t = time.time()
+        for _ in range(rows):
+            o = model()
+            o._load_self(row)
+        before = time.time() - t
+
+        hydrate = model._get_hydrator()
+        t = time.time()
+        for _ in range(rows):
+            hydrate(row)
+        after = time.time() - t
+
+        if hydrate(row).__dict__ != o.__dict__:
+            raise click.ClickException(f"{model.__name__}: hydrated instance differs from Schema.load")
+        click.echo(f"{model.__name__}: {rows / before:.0f} rows/s with Schema.load, {rows / after:.0f} rows/s hydrated ({before / after:.1f}x)")
+
+
+@commands.command('json')
+@click.option('--rows', default=100000, help="Number of OrderStat rows in the database")
+def bench_json(rows):
+    """Time loading and dumping a db.json of order stats with json and the serializer."""
+    rand = random.Random(0)
+    data = {
+        'OrderStat': {
+            str(i): {
+                'event': rand.randint(1, 10),
+                'drink': rand.choice([None, rand.randint(1, 40)]),
+                'drink_components': [rand.randint(1, 60) for _ in range(rand.randint(0, 4))],
+                'strength': rand.choice([None, 'light', 'normal', 'strong']),
+            }
+            for i in range(1, rows + 1)
+        },
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'db.json')
+        # What TinyDB's JSONStorage did
+        t = time.time()
+        with open(filename, 'w') as fp:
+            fp.write(json.dumps(data))
+        dump_before = time.time() - t
+        t = time.time()
+        with open(filename, 'r') as fp:
+            loaded = json.load(fp)
+        load_before = time.time() - t
+
+        storage = SerializerStorage(filename)
+        t = time.time()
+        storage.write(data)
+        dump_after = time.time() - t
+        size = os.path.getsize(filename)
+        t = time.time()
+        result = storage.read()
+        load_after = time.time() - t
+
+    if result != loaded:
+        raise click.ClickException("Data read back with the serializer differs")
+
+    name = 'orjson' if serializer.have_orjson else 'json (orjson is not installed)'
+    click.echo(f"{rows} rows, {size} bytes, serializer is using {name}")
+    click.echo(f"Dump: {dump_before * 1000:.0f}ms with json, {dump_after * 1000:.0f}ms with the serializer ({dump_before / dump_after:.1f}x)")
+    click.echo(f"Load: {load_before * 1000:.0f}ms with json, {load_after * 1000:.0f}ms with the serializer ({load_before / load_after:.1f}x)")
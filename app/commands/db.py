@@ -0,0 +1,117 @@
+import logging
+import os
+
+import click
+from flask.cli import AppGroup
+from flask import current_app
+
+from app.storage import open_backend, get_backend_class, get_filename
+from app.database import OrderStat, OrderStatRollup, Counter, Event, db
+from app.lib import archive
+
+
+logger = logging.getLogger(__name__)
+
+commands = AppGroup('db')
+
+
+def copy_tables(source, dest, replace=False):
+    for name in source.tables():
+        src_table = source.table(name)
+        dest_table = dest.table(name)
+        if dest_table.all():
+            if not replace:
+                raise click.ClickException(f"Table {name} is not empty, use --replace to overwrite it")
+            dest_table.truncate()
+        count = 0
+        for doc in src_table.all():
+            dest_table.insert(dict(doc), doc_id=doc.doc_id)
+            count += 1
+        logger.info("Copied %d documents in %s", count, name)
+
+
+@commands.command('import-json')
+@click.argument('filename', required=False)
+@click.option('--replace', is_flag=True, help="Replace tables that already contain data")
+def import_json(filename, replace):
+    """Import an existing db.json into the configured database backend."""
+    if current_app.config.get('DATABASE_BACKEND', 'json') == 'json':
+        raise click.ClickException("DATABASE_BACKEND is json, there is nothing to import into")
+
+    filename = filename or get_filename(current_app.config, 'json')
+    if not os.path.exists(filename):
+        raise click.ClickException(f"{filename} does not exist")
+
+    # The imported counters may be behind what caches have already seen
+    generation = Counter.get_value('menu')
+    source = get_backend_class('json')(filename)
+    dest = open_backend(current_app.config)
+    try:
+        with dest.transaction():
+            copy_tables(source, dest, replace=replace)
+    finally:
+        source.close()
+        dest.close()
+    Counter.incr('menu', max(generation - Counter.get_value('menu'), 0) + 1)
+
+
+@commands.command('rebuild-stats')
+def rebuild_stats():
+    """Recompute the order stats rollup from the raw order stats."""
+    total = OrderStatRollup.rebuild()
+    click.echo(f"Rebuilt stats rollup from {total} order stats")
+
+
+@commands.command('check-counters')
+@click.option('--fix', is_flag=True, help="Reset counters that don't match the order stats")
+def check_counters(fix):
+    """Check the order counters against the raw order stats."""
+    wrong = OrderStat.rebuild_counters() if fix else OrderStat.check_counters()
+    for key, (counter, actual) in sorted(wrong.items()):
+        click.echo(f"{key}: counter is {counter}, {actual} order stats")
+    if not wrong:
+        click.echo("Order counters are correct")
+    elif fix:
+        click.echo(f"Fixed {len(wrong)} counters")
+    else:
+        raise click.ClickException(f"{len(wrong)} counters are wrong, run with --fix to reset them")
+
+
+@commands.command('archive')
+@click.option('--compact', 'then_compact', is_flag=True, help="Compact the database afterwards")
+def archive_stats(then_compact):
+    """Move the order stats of past events into compressed archives."""
+    total = 0
+    for event in Event.all():
+        if event.is_current:
+            continue
+        stats = OrderStat._get_table().search({'event': event.doc_id})
+        if not stats:
+            continue
+        # The archive is safely on disk before anything is removed, and the
+        # rollup and counters are left as they are
+        count = archive.write_archive(event.doc_id, Event._get_schema().dump(event), stats)
+        OrderStat.delete_many([s.doc_id for s in stats])
+        click.echo(f"Archived {len(stats)} stats for {event.name}, {count} in its archive")
+        total += len(stats)
+    click.echo(f"Archived {total} stats to {archive.archive_dir()}")
+    if then_compact:
+        _compact()
+
+
+def _compact():
+    filename = get_filename(current_app.config)
+
+    def _size():
+        files = (filename, filename + '-wal', filename + '.snapshot')
+        return sum(os.path.getsize(f) for f in files if os.path.exists(f))
+
+    before = _size()
+    db().compact()
+    click.echo(f"Compacted {filename}: {before} -> {_size()} bytes")
+
+
+@commands.command('compact')
+def compact():
+    """Rewrite the database to give back space from removed documents."""
+    _compact()
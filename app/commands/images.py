@@ -0,0 +1,30 @@
+import os
+
+import click
+from flask.cli import AppGroup
+from flask import current_app
+
+from app.lib.images import generate_derivatives, get_derivatives, get_formats
+
+
+commands = AppGroup('images')
+
+
+@commands.command('build')
+@click.option('--force', is_flag=True, help="Regenerate derivatives that already exist")
+def build(force):
+    """Generate the resized copies of every uploaded image."""
+    data_dir = current_app.config['DATA_DIRECTORY']
+    derivatives = get_derivatives()
+    dirname = os.path.join(data_dir, 'images')
+    count = 0
+    for name in sorted(os.listdir(dirname)):
+        if name.startswith('.') or not os.path.isfile(os.path.join(dirname, name)):
+            continue
+        try:
+            generate_derivatives(data_dir, name, derivatives, force=force)
+            count += 1
+        except Exception as e:
+            click.echo(f"{name}: {e}", err=True)
+    formats = ', '.join(ext for ext, _ in get_formats())
+    click.echo(f"Built {', '.join(derivatives)} ({formats}) for {count} images")
@@ -1,5 +1,9 @@
+import asyncio
 import logging
+import os
+import socket
 import time
+import threading
 
 import click
 from flask.cli import AppGroup
@@ -10,46 +14,116 @@ try:
 except ImportError:
     pass
 
-from app.lib.printer import get_printer, print_order, PrintError
+from app.lib.printer import get_printer, get_printer_configs, print_order
+from app.lib.assets import get_asset_cache
+from app.lib import print_agent
 
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG)
 
 commands = AppGroup('queue')
 
 
+class PrintWorker(threading.Thread):
+    """Takes jobs for one printer from the API and prints them"""
+
+    def __init__(self, url, printer_config, assets):
+        super().__init__(name='print-' + printer_config['name'], daemon=True)
+        self.url = url
+        self.printer_config = printer_config
+        self.assets = assets
+        self.params = {
+            'worker': f'{socket.gethostname()}-{os.getpid()}-{printer_config["name"]}',
+            'printer': printer_config['name'],
+        }
+        self.printed = 0
+        self.failed = 0
+        self.print_time = 0
+
+    def run(self):
+        printer = None
+        while True:
+            try:
+                if printer is None:
+                    printer = get_printer(self.printer_config)
+
+                logger.debug("Get queued: %s %s", self.url, self.params)
+                res = requests.get(self.url, params=self.params)
+                res.raise_for_status()
+                job = res.json()['result']
+                if job is None:
+                    # There's no print job, just continue
+                    continue
+
+                t = time.time()
+                try:
+                    # Print the job, and tell the server it's done
+                    logger.debug("Printing job on %s: %s", self.printer_config['name'], job)
+                    print_order(printer, job, self.printer_config, self.assets)
+                except:
+                    logger.error("Failed to print", exc_info=True)
+                    self.failed += 1
+                    # Put it back so it can be retried
+                    action = '/release'
+                else:
+                    self.printed += 1
+                    action = ''
+                finally:
+                    self.print_time += time.time() - t
+                try:
+                    logger.debug("Inform api %s is done%s", job['id'], action)
+                    requests.post(self.url + '/' + str(job['id']) + action, params=self.params).raise_for_status()
+                except:
+                    logger.error("Failed to notify api job is done", exc_info=True)
+            except:
+                logger.error("Failed to get the print job", exc_info=True)
+                time.sleep(10)
+
+
 @commands.command('print')
-def run_print_queue():
+@click.option('--printer', 'printer_names', multiple=True, help="Only run these printers (default: all configured printers)")
+@click.option('--report-interval', default=60, help="Seconds between throughput reports")
+@click.option('--async', 'use_async', is_flag=True, help="Run every printer in one event loop, sharing one HTTP session (requires aiohttp)")
+def run_print_queue(printer_names, report_interval, use_async):
+    # python-escpos calls basicConfig() on import, which would make this a no-op without force
+    logging.basicConfig(level=logging.DEBUG, force=True)
     try:
         requests
     except NameError:
         raise RuntimeError("Requests is not installed")
+    if use_async and not print_agent.have_aiohttp:
+        raise RuntimeError("aiohttp is not installed")
 
     url = current_app.config['API_URL'] + '/print/job'
-    printer = get_printer()
+    printer_configs = get_printer_configs()
+    if printer_names:
+        printer_configs = [p for p in printer_configs if p['name'] in printer_names]
+    if not printer_configs:
+        raise click.ClickException("No printers to run")
+
+    assets = get_asset_cache(current_app.config)
+    if use_async:
+        agent = print_agent.AsyncPrintAgent(current_app.config['API_URL'], printer_configs, assets)
+        asyncio.run(agent.run(report_interval))
+        return
+
+    try:
+        res = requests.get(current_app.config['API_URL'] + '/print/assets')
+        res.raise_for_status()
+        asset_urls = res.json()['result']
+    except:
+        logger.error("Failed to get the list of assets to warm up", exc_info=True)
+        asset_urls = []
+    assets.warm(asset_urls)
+
+    workers = [PrintWorker(url, p, assets) for p in printer_configs]
+    for w in workers:
+        w.start()
+
+    start = time.time()
     while True:
-        try:
-            logger.debug("Get queued: %s", url)
-            res = requests.get(url)
-            res.raise_for_status()
-            job = res.json()['result']
-            if job is None:
-                # There's no print job, just continue
-                continue
+        time.sleep(report_interval)
+        minutes = (time.time() - start) / 60
+        for w in workers:
+            print_agent.log_throughput(w.printer_config['name'], w.printed, w.failed, w.print_time, minutes, w.is_alive())
 
-            try:
-                # Print the job, and tell the server it's done
-                logger.debug("Printing job: %s", job)
-                print_order(printer, job)
-            except:
-                logger.error("Failed to print", exc_info=True)
-            finally:
-                try:
-                    logger.debug("Inform api %s is done", job['id'])
-                    requests.post(url + '/' + str(job['id'])).raise_for_status()
-                except:
-                    logger.error("Failed to notify api job is done", exc_info=True)
-        except:
-            logger.error("Failed to get the print job", exc_info=True)
-            time.sleep(10)
@@ -1,47 +1,95 @@
 import os
+import heapq
+import time
+import itertools
 import uuid
-import threading
 import datetime
 
 from flask import g, current_app
 
-from tinydb import TinyDB, Query
-from tinydb.storages import JSONStorage
-from tinydb.middlewares import Middleware
+from tinydb import Query
+from tinydb.table import Document
 
-from marshmallow import Schema, fields
+from marshmallow import Schema, ValidationError, fields, missing
 
+from app.storage import open_backend
+from app.lib import archive
 
-class ThreadingMiddleware(Middleware):
-    locks = {}
 
-    def __init__(self, name, storage_cls):
-        # Initialize the parent constructor
-        super().__init__(storage_cls)
-        self.name = name
-        self.locks.setdefault(self.name, threading.RLock())
+def db():
+    if 'db' not in g:
+        g.db = open_backend(current_app.config)
+    return g.db
 
-    def read(self):
-        with self.locks[self.name]:
-            return self.storage.read()
 
-    def write(self, data):
-        with self.locks[self.name]:
-            return self.storage.write(data)
+def identity_map():
+    """Model instances loaded during this request, by (table name, doc_id)"""
+    if 'identity_map' not in g:
+        g.identity_map = {}
+    return g.identity_map
 
 
-def db():
-    if 'db' not in g:
-        filename = os.path.join(current_app.config['DATA_DIRECTORY'], 'db.json')
-        g.db = TinyDB(filename, storage=ThreadingMiddleware(filename, JSONStorage))
-    return g.db
+def close_db(exc=None):
+    backend = g.pop('db', None)
+    if backend is not None:
+        backend.close()
 
 
 class BaseSchema(Schema):
     pass
 
 
+def _build_hydrator(cls):
+    """Build a function that turns a stored row into an instance of ``cls``.
+
+    Rows were validated by save() on the way in, so instead of a full
+    Schema.load the values that JSON stores natively are taken as they are
+    (lists and dicts copied, the row may be shared with the backend's
+    cache) and only the rest, i.e. dates, go through their field.  Defaults
+    are filled in the same way load does.  Instances still have a __dict__
+    rather than __slots__, as forms' populate_obj sets arbitrary attributes
+    on them.
+    """
+    spec = []
+    for name, field in cls._get_schema().fields.items():
+        if field.dump_only:
+            continue
+        if isinstance(field, (fields.String, fields.Integer, fields.Float, fields.Boolean)):
+            convert = None
+        elif isinstance(field, fields.List):
+            convert = list
+        elif isinstance(field, fields.Dict):
+            convert = dict
+        else:
+            convert = field.deserialize
+        default = field.load_default if hasattr(field, 'load_default') else field.missing
+        spec.append((name, field.data_key or name, convert, default))
+
+    def hydrate(data):
+        values = {'doc_id': getattr(data, 'doc_id', None)}
+        for name, key, convert, default in spec:
+            if key in data:
+                v = data[key]
+                if convert is not None and v is not None:
+                    v = convert(v)
+            elif default is missing:
+                continue
+            else:
+                v = default() if callable(default) else default
+            values[name] = v
+        o = cls.__new__(cls)
+        o.__dict__.update(values)
+        return o
+
+    return hydrate
+
+
 class Model:
+    # Fields that are frequently used in find() filters, backends may index these
+    __indexes__ = ()
+    # Counter bumped by every write, for caches built from this model
+    __generation__ = None
+
     def __init__(self, *args, **kwargs):
         self._load_self(kwargs)
 
@@ -51,7 +99,7 @@ class Model:
 
     @classmethod
     def _get_table(cls):
-        return db().table(cls._get_table_name())
+        return db().table(cls._get_table_name(), indexes=cls.__indexes__)
 
     @classmethod
     def _get_schema(cls):
@@ -59,12 +107,31 @@ class Model:
             cls._schema_instance = cls._schema()
         return cls._schema_instance
 
+    @classmethod
+    def _get_hydrator(cls):
+        if '_hydrator' not in cls.__dict__:
+            cls._hydrator = _build_hydrator(cls)
+        return cls._hydrator
+
     @classmethod
     def _load_raw(cls, data):
-        o = cls()
-        o._load_self(data)
+        key = (cls._get_table_name(), data.doc_id)
+        imap = identity_map()
+        o = imap.get(key)
+        if o is None:
+            o = cls._get_hydrator()(data)
+            imap[key] = o
         return o
 
+    @classmethod
+    def _load_fresh(cls, data):
+        """Like _load_raw, but replaces any instance already in the identity map"""
+        identity_map().pop((cls._get_table_name(), data.doc_id), None)
+        return cls._load_raw(data)
+
+    def _forget(self):
+        identity_map().pop((self._get_table_name(), self.doc_id), None)
+
     def _load_self(self, data):
         res = self._get_schema().load(data)
         self.doc_id = getattr(data, 'doc_id', None)
@@ -83,51 +150,138 @@ class Model:
     def all(cls, sort_key=None):
         def _fetch():
             for res in cls._get_table().all():
-                o = cls()
-                o._load_self(res)
-                yield o
+                yield cls._load_raw(res)
 
         yield from cls._sorted_results(_fetch(), sort_key)
 
+    @classmethod
+    def all_detached(cls):
+        """Like all(), but the instances aren't shared with the request's
+        identity map, for keeping beyond the request"""
+        return list(map(cls._get_hydrator(), cls._get_table().all()))
+
     @classmethod
     def get(cls, doc_id):
-        res = cls._get_table().get(doc_id=doc_id)
+        o = identity_map().get((cls._get_table_name(), doc_id))
+        if o is not None:
+            return o
+        res = cls._get_table().get(doc_id)
         if not res:
             return None
-        out = cls()
-        out._load_self(res)
-        return out
+        return cls._load_raw(res)
+
+    @classmethod
+    def get_many(cls, doc_ids, preserve_order=True):
+        """Get all of ``doc_ids`` with a single read of the table, skipping
+        any that don't exist.  Unless ``preserve_order`` is set the results
+        are in doc_id order, without duplicates."""
+        name = cls._get_table_name()
+        imap = identity_map()
+        doc_ids = list(doc_ids)
+        missing = [i for i in dict.fromkeys(doc_ids) if (name, i) not in imap]
+        if missing:
+            for res in cls._get_table().get_many(missing):
+                if res:
+                    cls._load_raw(res)
+
+        if not preserve_order:
+            doc_ids = sorted(set(doc_ids))
+        return [imap[(name, i)] for i in doc_ids if (name, i) in imap]
 
     @classmethod
     def find(cls, *doc_ids, sort_key=None, custom_conds=None, **filters):
         def _fetch():
             if doc_ids:
-                return list(filter(None, (cls.get(i) for i in doc_ids)))
+                return cls.get_many(doc_ids)
 
             query = Query()
-            conditions = []
+            search = None
             for cond in custom_conds or []:
-                conditions.append(cond(query))
-            for k, v in filters.items():
-                conditions.append(getattr(query, k) == v)
-            search = conditions.pop(0)
-            for cond in conditions:
-                search = search & cond
-            return list(map(cls._load_raw, cls._get_table().search(search)))
+                search = cond(query) if search is None else search & cond(query)
+            return list(map(cls._load_raw, cls._get_table().search(filters, search)))
 
         return list(cls._sorted_results(_fetch(), sort_key))
 
     def save(self):
-        data = self._get_schema().dump(self)
-        if self.doc_id:
-            self._get_table().update(data, doc_ids=[self.doc_id])
-        else:
-            self.doc_id = self._get_table().insert(data)
+        schema = self._get_schema()
+        data = schema.dump(self)
+        # Rows are trusted when they're read back, so this is where they're checked
+        errors = schema.validate(data)
+        if errors:
+            raise ValidationError(errors)
+        with db().transaction():
+            if self.doc_id:
+                self._forget()
+                self._get_table().update(data, self.doc_id)
+            else:
+                self.doc_id = self._get_table().insert(data)
+            if self.__generation__:
+                Counter.incr(self.__generation__)
+
+    @classmethod
+    def delete_many(cls, doc_ids):
+        """Delete many documents in one write, by doc_id"""
+        imap = identity_map()
+        with db().transaction():
+            table = cls._get_table()
+            for doc_id in doc_ids:
+                imap.pop((cls._get_table_name(), doc_id), None)
+                table.remove(doc_id)
+            if cls.__generation__:
+                Counter.incr(cls.__generation__)
+
+    @classmethod
+    def transaction(cls):
+        """Group writes into one transaction, see Backend.transaction"""
+        return db().transaction()
+
+    @classmethod
+    def bulk_update(cls, changes):
+        """Apply ``{doc_id: {field: value}}`` to many documents in one write"""
+        if not changes:
+            return
+        schema = cls._get_schema()
+        # dump() fills in defaults for the fields that aren't given, which
+        # would overwrite them
+        data = {doc_id: {k: v for k, v in schema.dump(values).items() if k in values} for doc_id, values in changes.items()}
+        for values in data.values():
+            errors = schema.validate(values, partial=True)
+            if errors:
+                raise ValidationError(errors)
+
+        imap = identity_map()
+        with db().transaction():
+            for doc_id in data:
+                imap.pop((cls._get_table_name(), doc_id), None)
+            cls._get_table().update_many(data)
+            if cls.__generation__:
+                Counter.incr(cls.__generation__)
 
     def delete(self):
         if self.doc_id:
-            self._get_table().remove(doc_ids=[self.doc_id])
-            self.doc_id = None
+            with db().transaction():
+                self._forget()
+                self._get_table().remove(self.doc_id)
+                self.doc_id = None
+                if self.__generation__:
+                    Counter.incr(self.__generation__)
+
+
+def prefetch(objs, attr, model):
+    """Load every ``model`` referenced by ``attr`` on ``objs`` in one go.
+
+    ``attr`` may hold a single doc_id or a list of them.  The loaded
+    instances are returned by doc_id, and later ``model.get()`` calls in the
+    same request are served from the identity map.
+    """
+    doc_ids = []
+    for o in objs:
+        v = getattr(o, attr, None)
+        if isinstance(v, (list, tuple)):
+            doc_ids.extend(v)
+        elif v:
+            doc_ids.append(v)
+    return {o.doc_id: o for o in model.get_many(doc_ids, preserve_order=False)}
 
 
 def HasImageMixin(image_field_name='image'):
@@ -139,6 +293,8 @@ def HasImageMixin(image_field_name='image'):
                 filename = os.path.join(current_app.config['DATA_DIRECTORY'], 'images', imgname)
                 if os.path.exists(filename):
                     os.unlink(filename)
+                from app.lib import images
+                images.delete_derivatives(current_app.config['DATA_DIRECTORY'], imgname, images.get_derivatives())
     return HasImageMixinImpl
 
 
@@ -148,10 +304,11 @@ class OrderableMixin:
 
     @classmethod
     def set_order(cls, order_by_id):
-        for doc in cls.all():
-            if doc.doc_id in order_by_id and doc.order != order_by_id[doc.doc_id]:
-                doc.order = order_by_id[doc.doc_id]
-                doc.save()
+        cls.bulk_update({
+            doc.doc_id: {'order': order_by_id[doc.doc_id]}
+            for doc in cls.get_many(order_by_id)
+            if doc.order != order_by_id[doc.doc_id]
+        })
 
 
 # TODO: this probably doesn't belong here
@@ -165,6 +322,9 @@ DEFAULT_STRENGTH = 'normal'
 
 
 class Drink(OrderableMixin, HasImageMixin(), Model):
+    __indexes__ = ('in_stock', 'is_orderable')
+    __generation__ = 'menu'
+
     class _schema(OrderableMixin._schema, BaseSchema):
         name = fields.Str(missing=None)
         description = fields.Str(missing=None)
@@ -182,6 +342,8 @@ class DrinkComponent(OrderableMixin, HasImageMixin(), Model):
         'mixer': 'Mixer',
         'other': 'Other',
     }
+    __indexes__ = ('in_stock',)
+    __generation__ = 'menu'
 
     class _schema(OrderableMixin._schema, BaseSchema):
         name = fields.Str(missing=None)
@@ -192,12 +354,16 @@ class DrinkComponent(OrderableMixin, HasImageMixin(), Model):
 
 
 class SavedOrder(Model):
+    __generation__ = 'menu'
+
     class _schema(BaseSchema):
         drink_name = fields.Str(missing=None)
         drink_components = fields.List(fields.Integer(), missing=lambda: [])
 
 
 class Event(Model):
+    __indexes__ = ('is_current',)
+
     class _schema(BaseSchema):
         name = fields.Str(missing=None)
         date = fields.DateTime(missing=datetime.datetime.utcnow)
@@ -217,6 +383,9 @@ class Event(Model):
 
 
 class Order(Model):
+    __indexes__ = ('printed',)
+    __generation__ = 'orders'
+
     class _schema(BaseSchema):
         event = fields.Integer(missing=None)
         name = fields.Str(missing=None)
@@ -225,10 +394,255 @@ class Order(Model):
         drink_components = fields.List(fields.Integer(), missing=lambda: [])
         strength = fields.Str(missing=None)
         printed = fields.Boolean(default=False, missing=False)
-        print_queued = fields.Integer(default=0, missing=0)
+        # The ticket's text, resolved when the order was placed so printing
+        # it doesn't have to look up the drink; see set_printable()
+        printable = fields.Dict(allow_none=True, missing=None)
+        printable_for = fields.List(fields.Raw(allow_none=True), allow_none=True, missing=None)
+
+    # The fields printable is built from
+    PRINTABLE_FROM = ('name', 'drink_name', 'drink', 'drink_components', 'strength')
+
+    def _printable_source(self):
+        return [getattr(self, k) for k in self.PRINTABLE_FROM]
+
+    def set_printable(self, printable):
+        """Keep ``printable`` until the order is edited"""
+        self.printable = printable
+        self.printable_for = self._printable_source()
+
+    def save(self):
+        with db().transaction():
+            if self.printable is not None and self.printable_for != self._printable_source():
+                # Edited since it was resolved, queued jobs have copies too
+                self.printable = self.printable_for = None
+                if self.doc_id:
+                    PrintJob.bulk_update({job.doc_id: {'printable': None} for job in PrintJob.find(order=self.doc_id) if job.printable is not None})
+            super().save()
+
+
+class PrintJob(Model):
+    """A FIFO queue of orders to print, with leases.
+
+    A printer claims the oldest available job, which leases it for a while;
+    the job is deleted when the printer completes it.  If the printer goes
+    away without completing or releasing the job, the lease expires and the
+    job can be claimed again.  Only pending jobs are kept, and claiming
+    reads them in queue order through the index on state, so a claim reads
+    only the jobs it takes (and any expired ones it drops on the way).
+    """
+    __indexes__ = ('state', 'order', 'printer')
+
+    QUEUED = 'queued'
+    CLAIMED = 'claimed'
+
+    class _schema(BaseSchema):
+        order = fields.Integer(missing=None)
+        # Name of the printer the job was routed to, or None for any printer
+        printer = fields.Str(allow_none=True, missing=None)
+        state = fields.Str(default='queued', missing='queued')
+        created = fields.Float(missing=time.time)
+        lease_expires = fields.Float(default=0, missing=0)
+        claimed_by = fields.Str(allow_none=True, missing=None)
+        attempts = fields.Integer(default=0, missing=0)
+        # A copy of the order's printable, so claiming the job is one read
+        printable = fields.Dict(allow_none=True, missing=None)
+
+    def is_pending(self, now=None):
+        now = now or time.time()
+        return self.state == self.QUEUED or self.lease_expires > now
+
+    @classmethod
+    def enqueue(cls, order_id, printer=None, printable=None):
+        """Queue an order, unless it's already waiting to be printed"""
+        with db().transaction():
+            res = cls.find(order=order_id, printer=printer, state=cls.QUEUED)
+            if res:
+                return res[0]
+            job = cls(order=order_id, printer=printer, printable=printable)
+            job.save()
+            return job
+
+    @classmethod
+    def claim(cls, worker, printer=None, lease=30, max_age=None, max_attempts=None):
+        """Lease the oldest available job to ``worker``, or return None.
+
+        If ``printer`` is given, only jobs routed to that printer (or to no
+        particular printer) are considered.  Jobs older than ``max_age``
+        seconds, or that have already been claimed ``max_attempts`` times,
+        are dropped instead.
+        """
+        res = cls.claim_many(worker, 1, printer=printer, lease=lease, max_age=max_age, max_attempts=max_attempts)
+        return res[0] if res else None
+
+    @classmethod
+    def _claimable(cls, table, printer, now, limit):
+        """The first ``limit`` jobs that can be claimed, oldest first.
+
+        Queued jobs are read through the index on state, which keeps them in
+        queue order.  Claimed jobs whose lease has run out go back in at
+        their place; there are only as many claimed jobs as printers are
+        working on.
+        """
+        if printer:
+            queued = [{'state': cls.QUEUED, 'printer': printer}, {'state': cls.QUEUED, 'printer': None}]
+        else:
+            queued = [{'state': cls.QUEUED}]
+        streams = [table.search(filters, limit=limit) for filters in queued]
+        streams.append([
+            doc for doc in table.search({'state': cls.CLAIMED})
+            if doc['lease_expires'] <= now and (not printer or doc.get('printer') in (printer, None))
+        ])
+        return list(itertools.islice(heapq.merge(*streams, key=lambda d: d.doc_id), limit))
+
+    @classmethod
+    def claim_many(cls, worker, max_jobs, printer=None, lease=30, max_age=None, max_attempts=None):
+        """Lease up to ``max_jobs`` of the oldest available jobs to ``worker``
+        in one write, oldest first, see claim()"""
+        table = cls._get_table()
+        now = time.time()
+        claimed = []
+        with db().transaction():
+            changes = {}
+            stale = []
+            limit = max_jobs
+            while len(changes) < max_jobs:
+                candidates = cls._claimable(table, printer, now, limit)
+                # Nothing is written until the end, so the jobs already seen
+                # come first again
+                for doc in candidates[len(changes) + len(stale):]:
+                    if (max_age and now - doc['created'] > max_age) or (max_attempts and doc['attempts'] >= max_attempts):
+                        stale.append(doc.doc_id)
+                        continue
+                    changes[doc.doc_id] = {
+                        'state': cls.CLAIMED,
+                        'claimed_by': worker,
+                        'lease_expires': now + lease,
+                        'attempts': doc['attempts'] + 1,
+                    }
+                    doc.update(changes[doc.doc_id])
+                    claimed.append(cls._load_fresh(doc))
+                    if len(changes) >= max_jobs:
+                        break
+                if len(candidates) < limit:
+                    break
+                # Stale jobs took some of the places, look further
+                limit *= 2
+            for doc_id in stale:
+                table.remove(doc_id)
+            if changes:
+                table.update_many(changes)
+        return claimed
+
+    @classmethod
+    def _get_claimed(cls, job_id, worker):
+        doc = cls._get_table().get(job_id)
+        if not doc or doc['state'] != cls.CLAIMED:
+            return None
+        if worker is not None and doc['claimed_by'] != worker:
+            return None
+        return doc
+
+    @classmethod
+    def heartbeat(cls, job_id, worker=None, lease=30):
+        """Extend the lease on a job, returns False if it's no longer held by ``worker``"""
+        with db().transaction():
+            doc = cls._get_claimed(job_id, worker)
+            if not doc:
+                return False
+            cls._get_table().update({'lease_expires': time.time() + lease}, job_id)
+            return True
+
+    @classmethod
+    def complete(cls, job_id, worker=None):
+        """Remove a finished job, returns it or None if it's no longer held by ``worker``"""
+        with db().transaction():
+            doc = cls._get_claimed(job_id, worker)
+            if not doc:
+                return None
+            job = cls._load_fresh(doc)
+            job.delete()
+            return job
+
+    @classmethod
+    def complete_many(cls, job_ids, worker=None):
+        """Remove many finished jobs in one write, returns those that were held by ``worker``"""
+        with db().transaction():
+            docs = [cls._get_claimed(i, worker) for i in dict.fromkeys(job_ids)]
+            jobs = [cls._load_fresh(doc) for doc in docs if doc]
+            cls.delete_many([job.doc_id for job in jobs])
+            return jobs
+
+    @classmethod
+    def release(cls, job_id, worker=None):
+        """Put a claimed job back at its place in the queue"""
+        return bool(cls.release_many([job_id], worker))
+
+    @classmethod
+    def release_many(cls, job_ids, worker=None):
+        """Put many claimed jobs back in one write, returns the IDs of those
+        that were held by ``worker``"""
+        with db().transaction():
+            released = [i for i in dict.fromkeys(job_ids) if cls._get_claimed(i, worker)]
+            cls._get_table().update_many({i: {'state': cls.QUEUED, 'claimed_by': None, 'lease_expires': 0} for i in released})
+            return released
+
+
+# Counter values written by this process, by (data directory, key)
+_local_counters = {}
+
+
+class Counter(Model):
+    """Named counters, updated atomically on the raw rows"""
+    __indexes__ = ('key',)
+
+    class _schema(BaseSchema):
+        key = fields.Str(allow_none=False)
+        value = fields.Integer(default=0, missing=0)
+
+    @classmethod
+    def get_value(cls, key, default=0):
+        res = cls._get_table().search({'key': key})
+        return res[0].get('value', 0) if res else default
+
+    @classmethod
+    def get_values(cls, prefix=''):
+        """Every counter whose key starts with ``prefix``, by key"""
+        return {r['key']: r.get('value', 0) for r in cls._get_table().all() if r.get('key', '').startswith(prefix)}
+
+    @classmethod
+    def set_value(cls, key, value):
+        table = cls._get_table()
+        with db().transaction():
+            res = table.search({'key': key})
+            if res:
+                table.update({'value': value}, res[0].doc_id)
+            else:
+                table.insert({'key': key, 'value': value})
+
+    @classmethod
+    def incr(cls, key, by=1):
+        """Add ``by`` to a counter, returns the new value"""
+        table = cls._get_table()
+        with db().transaction():
+            res = table.search({'key': key})
+            if res:
+                value = res[0].get('value', 0) + by
+                table.update({'value': value}, res[0].doc_id)
+            else:
+                value = by
+                table.insert({'key': key, 'value': value})
+        _local_counters[(current_app.config['DATA_DIRECTORY'], key)] = value
+        return value
+
+    @classmethod
+    def local_value(cls, key):
+        """The value this process last set ``key`` to, without reading storage"""
+        return _local_counters.get((current_app.config['DATA_DIRECTORY'], key))
 
 
 class RuntimeConfig(Model):
+    __generation__ = 'config'
+
     class _schema(BaseSchema):
         user_pass = fields.Str(allow_none=True, missing=None)
         admin_pass = fields.Str(allow_none=True, missing=None)
@@ -249,6 +663,9 @@ class RuntimeConfig(Model):
 
 
 class Device(Model):
+    __indexes__ = ('device_id',)
+    __generation__ = 'devices'
+
     class _schema(BaseSchema):
         device_id = fields.Str(allow_none=False)
         is_house_device = fields.Boolean(allow_none=False, missing=False)
@@ -264,13 +681,165 @@ class Device(Model):
 
 
 class OrderStat(Model):
+    __indexes__ = ('event',)
+
     class _schema(BaseSchema):
         event = fields.Integer(missing=None)
         drink = fields.Integer(missing=None)
         drink_components = fields.List(fields.Integer(), missing=lambda: [])
         strength = fields.Str(missing=None)
 
+    COUNTER_ALL = 'orders:all'
+    COUNTER_EVENT = 'orders:event:'
+
     @classmethod
     def from_order(cls, order):
         o = cls(event=Event.get_current_id(), drink=order.drink, drink_components=order.drink_components[:], strength=order.strength)
-        o.save()
+        with db().transaction():
+            cls._ensure_counters()
+            o.save()
+            OrderStatRollup.add(o.event, o.drink, o.strength)
+            for component in o.drink_components:
+                ComponentStatRollup.add(o.event, component)
+            Counter.incr(cls.COUNTER_ALL)
+            Counter.incr(cls.COUNTER_EVENT + str(o.event))
+
+    @classmethod
+    def count(cls, event=None):
+        """Orders served during ``event``, or all time if it's None, without reading the stats"""
+        key = cls.COUNTER_ALL if event is None else cls.COUNTER_EVENT + str(event)
+        cls._ensure_counters()
+        return Counter.get_value(key)
+
+    @classmethod
+    def _ensure_counters(cls):
+        # Databases from before the counters existed get them on first use
+        if Counter.get_value(cls.COUNTER_ALL, None) is None:
+            cls.rebuild_counters()
+
+    @classmethod
+    def iter_raw(cls, event=None):
+        """Every stat as a raw document, both those in the database and
+        those moved to archives by ``flask db archive``, optionally only
+        for one event"""
+        archived = archive.archived_events()
+        if event is not None:
+            archived &= {event}
+        archived_ids = {}
+        for event_id in sorted(archived):
+            data = archive.read_archive(event_id)
+            archived_ids[event_id] = set()
+            for stat in data['stats']:
+                archived_ids[event_id].add(stat['doc_id'])
+                yield Document({k: v for k, v in stat.items() if k != 'doc_id'}, doc_id=stat['doc_id'])
+
+        live = cls._get_table().all() if event is None else cls._get_table().search({'event': event})
+        for stat in live:
+            # Left behind if archiving was interrupted before removing them
+            if stat.doc_id not in archived_ids.get(stat.get('event'), ()):
+                yield stat
+
+    @classmethod
+    def count_stats(cls):
+        """Count the raw OrderStats, as {counter key: count}"""
+        counts = {cls.COUNTER_ALL: 0}
+        for stat in cls.iter_raw():
+            key = cls.COUNTER_EVENT + str(stat.get('event'))
+            counts[key] = counts.get(key, 0) + 1
+            counts[cls.COUNTER_ALL] += 1
+        return counts
+
+    @classmethod
+    def check_counters(cls):
+        """Compare the counters to the raw stats, returns {key: (counter, actual)} for those that differ"""
+        with db().transaction():
+            counts = cls.count_stats()
+            current = Counter.get_values(cls.COUNTER_EVENT)
+            current[cls.COUNTER_ALL] = Counter.get_value(cls.COUNTER_ALL, None)
+        return {
+            key: (current.get(key), counts.get(key, 0))
+            for key in set(counts) | set(current)
+            # A counter that doesn't exist yet is right if there's nothing to count
+            if (current.get(key) or 0) != counts.get(key, 0)
+        }
+
+    @classmethod
+    def rebuild_counters(cls):
+        """Reset the counters from the raw stats, returns the ones that were wrong as check_counters does"""
+        with db().transaction():
+            wrong = cls.check_counters()
+            for key, (_, actual) in wrong.items():
+                Counter.set_value(key, actual)
+            if Counter.get_value(cls.COUNTER_ALL, None) is None:
+                # There are no stats yet, this marks the counters as built
+                Counter.set_value(cls.COUNTER_ALL, 0)
+        return wrong
+
+
+def _add_count(model, key, count):
+    # Work on the raw rows - the identity map may hold a stale count from earlier in the request
+    table = model._get_table()
+    with db().transaction():
+        res = table.search(key)
+        if res:
+            table.update({'count': res[0].get('count', 0) + count}, res[0].doc_id)
+        else:
+            table.insert(model._get_schema().dump(dict(key, count=count)))
+
+
+class OrderStatRollup(Model):
+    """Count of OrderStats by (event, drink, strength), kept up to date by
+    OrderStat.from_order so the stats page doesn't have to read every stat"""
+    __indexes__ = ('event',)
+
+    class _schema(BaseSchema):
+        event = fields.Integer(allow_none=True, missing=None)
+        drink = fields.Integer(allow_none=True, missing=None)
+        strength = fields.Str(allow_none=True, missing=None)
+        count = fields.Integer(default=0, missing=0)
+
+    @classmethod
+    def add(cls, event, drink, strength, count=1):
+        _add_count(cls, {'event': event, 'drink': drink, 'strength': strength}, count)
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute the rollup, and the components rollup, from the raw
+        OrderStats, including archived ones, returns the number of stats
+        counted"""
+        counts = {}
+        component_counts = {}
+        total = 0
+        table = cls._get_table()
+        component_table = ComponentStatRollup._get_table()
+        with db().transaction():
+            for stat in OrderStat.iter_raw():
+                key = (stat.get('event'), stat.get('drink'), stat.get('strength'))
+                counts[key] = counts.get(key, 0) + 1
+                for component in stat.get('drink_components') or []:
+                    key = (stat.get('event'), component)
+                    component_counts[key] = component_counts.get(key, 0) + 1
+                total += 1
+
+            table.truncate()
+            for (event, drink, strength), count in counts.items():
+                table.insert(cls._get_schema().dump({'event': event, 'drink': drink, 'strength': strength, 'count': count}))
+            component_table.truncate()
+            for (event, component), count in component_counts.items():
+                component_table.insert(ComponentStatRollup._get_schema().dump({'event': event, 'component': component, 'count': count}))
+        return total
+
+
+class ComponentStatRollup(Model):
+    """Number of times each DrinkComponent was ordered, by event, kept up
+    to date alongside OrderStatRollup"""
+    __indexes__ = ('event',)
+
+    class _schema(BaseSchema):
+        event = fields.Integer(allow_none=True, missing=None)
+        component = fields.Integer(allow_none=True, missing=None)
+        count = fields.Integer(default=0, missing=0)
+
+    @classmethod
+    def add(cls, event, component, count=1):
+        _add_count(cls, {'event': event, 'component': component}, count)
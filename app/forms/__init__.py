@@ -7,6 +7,8 @@ from flask_wtf import FlaskForm
 from wtforms import ValidationError
 import magic
 
+from app.lib import images
+
 
 mimetypes.init()
 
@@ -26,22 +28,23 @@ def HasImageMixin(image_field_name='image'):
             if self.image_field_data:
                 # Remove the old image if it exists
                 if old_img:
-                    old_img = os.path.join(current_app.config['DATA_DIRECTORY'], 'images', getattr(obj, image_field_name))
-                    if os.path.exists(old_img):
-                        os.unlink(old_img)
+                    data_dir = current_app.config['DATA_DIRECTORY']
+                    if os.path.exists(images.image_path(data_dir, old_img)):
+                        os.unlink(images.image_path(data_dir, old_img))
+                    images.delete_derivatives(data_dir, old_img, images.get_derivatives())
 
                 mime_data, file, filename = self.image_field_data
+
+                def _save(fp):
+                    chunk = mime_data
+                    while chunk:
+                        written = 0
+                        while written < len(chunk):
+                            written += fp.write(chunk[written:])
+                        chunk = file.read(8192)
+
                 try:
-                    with open(os.path.join(current_app.config['DATA_DIRECTORY'], 'images', filename), 'wb') as fp:
-                        while True:
-                            chunk = mime_data or file.read(8192)
-                            if not chunk:
-                                break
-                            written = 0
-                            while written < len(chunk):
-                                written += fp.write(chunk[written:])
-
-                            mime_data = None
+                    images.save_image_atomic(filename, _save)
                     return filename
                 finally:
                     file.close()
@@ -0,0 +1,72 @@
+import gzip
+import json
+import os
+import re
+import tempfile
+
+from flask import current_app
+
+
+_FILENAME_RE = re.compile(r'^event-(\d+)\.json\.gz$')
+
+
+def archive_dir():
+    return os.path.join(current_app.config['DATA_DIRECTORY'], 'archive')
+
+
+def archive_path(event_id):
+    return os.path.join(archive_dir(), f'event-{event_id}.json.gz')
+
+
+def archived_events():
+    """IDs of the events that have an archive"""
+    try:
+        names = os.listdir(archive_dir())
+    except FileNotFoundError:
+        return set()
+    return {int(m.group(1)) for m in map(_FILENAME_RE.match, names) if m}
+
+
+def read_archive(event_id):
+    """An event's archive, {'event': {...}, 'stats': [{..., 'doc_id': n}]}, or None"""
+    try:
+        with gzip.open(archive_path(event_id), 'rt', encoding='utf-8') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def write_archive(event_id, event, stats):
+    """Add ``stats`` (documents) to an event's archive.
+
+    Stats already in the archive are replaced rather than duplicated, so
+    archiving the same event again after an interruption is safe.  The file
+    is synced and renamed into place before this returns, the caller can
+    then remove the stats from the database.
+    """
+    existing = read_archive(event_id) or {'stats': []}
+    by_id = {s['doc_id']: s for s in existing['stats']}
+    for stat in stats:
+        by_id[stat.doc_id] = dict(stat, doc_id=stat.doc_id)
+    data = {'event': event, 'stats': sorted(by_id.values(), key=lambda s: s['doc_id'])}
+
+    dirname = archive_dir()
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.archive-')
+    try:
+        with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as fp:
+            fp.write(json.dumps(data).encode('utf-8'))
+        with open(tmp, 'rb') as fp:
+            os.fsync(fp.fileno())
+        os.replace(tmp, archive_path(event_id))
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+    dir_fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return len(data['stats'])
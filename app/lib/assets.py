@@ -0,0 +1,173 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import requests
+except ImportError:
+    pass
+
+
+logger = logging.getLogger(__name__)
+
+
+class AssetCache:
+    """On-disk cache of remote files, for the print worker's logos.
+
+    Files are stored under the SHA-256 of their content, with an index that
+    maps each URL to its file along with the validators (ETag and
+    Last-Modified) to revalidate it with.  Lookups never wait on the network:
+    a missing or stale entry is fetched in the background, and the least
+    recently used files are removed once the cache is larger than
+    ``max_bytes``.
+    """
+
+    def __init__(self, directory, max_bytes=10 * 1024 * 1024, revalidate_after=300):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self.index_filename = os.path.join(directory, 'index.json')
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='assets')
+        self.session = requests.Session()
+
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.index_filename, 'r') as fp:
+                self.index = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            self.index = {}
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def _save_index(self):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.index-')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(self.index, fp)
+        os.replace(tmp, self.index_filename)
+
+    def get(self, url):
+        """The local filename for ``url``, or None if it isn't cached yet"""
+        with self.lock:
+            entry = self.index.get(url)
+            if entry and os.path.exists(self._path(entry['hash'])):
+                entry['used'] = time.time()
+                if time.time() - entry.get('checked', 0) > self.revalidate_after:
+                    self._schedule(url)
+                return self._path(entry['hash'])
+            self._schedule(url)
+            return None
+
+    def _schedule(self, url):
+        if url not in self.pending:
+            self.pending.add(url)
+            self.executor.submit(self._fetch_logged, url)
+
+    def _fetch_logged(self, url):
+        try:
+            self.fetch(url)
+        except:
+            logger.error("Failed to fetch %s", url, exc_info=True)
+        finally:
+            with self.lock:
+                self.pending.discard(url)
+
+    def fetch(self, url):
+        """Download or revalidate ``url``, blocking until it's done"""
+        with self.lock:
+            entry = dict(self.index.get(url) or {})
+        headers = {}
+        if entry and os.path.exists(self._path(entry['hash'])):
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        res = self.session.get(url, headers=headers, stream=True, timeout=30)
+        if res.status_code == 304:
+            res.close()
+            with self.lock:
+                current = self.index.get(url)
+                if current is not None:
+                    current['checked'] = time.time()
+                    self._save_index()
+                    return self._path(current['hash'])
+            # Evicted while it was being revalidated, download it again
+            res = self.session.get(url, stream=True, timeout=30)
+        res.raise_for_status()
+
+        digest = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.download-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                for chunk in res.iter_content(chunk_size=8192):
+                    digest.update(chunk)
+                    fp.write(chunk)
+            filename = self._path(digest.hexdigest())
+            os.replace(tmp, filename)
+        except:
+            os.unlink(tmp)
+            raise
+
+        with self.lock:
+            now = time.time()
+            self.index[url] = {
+                'hash': digest.hexdigest(),
+                'size': os.path.getsize(filename),
+                'etag': res.headers.get('ETag'),
+                'last_modified': res.headers.get('Last-Modified'),
+                'checked': now,
+                'used': now,
+            }
+            self._evict()
+            self._save_index()
+        return filename
+
+    def _evict(self):
+        # Several URLs may share one file, count each file once
+        def _files():
+            files = {}
+            for url, entry in self.index.items():
+                files[entry['hash']] = max(files.get(entry['hash'], 0), entry.get('used', 0))
+            return files
+
+        sizes = {e['hash']: e['size'] for e in self.index.values()}
+        files = _files()
+        while len(files) > 1 and sum(sizes[h] for h in files) > self.max_bytes:
+            lru = min(files, key=files.get)
+            self.index = {u: e for u, e in self.index.items() if e['hash'] != lru}
+            try:
+                os.unlink(self._path(lru))
+            except FileNotFoundError:
+                pass
+            files = _files()
+
+        # Clean up anything left behind by an earlier process
+        for name in os.listdir(self.directory):
+            if name not in files and name != 'index.json' and not name.startswith('.'):
+                os.unlink(self._path(name))
+
+    def warm(self, urls=()):
+        """Fetch ``urls`` and revalidate everything already cached, blocking until done"""
+        with self.lock:
+            urls = set(urls) | set(self.index)
+        for url in urls:
+            try:
+                self.fetch(url)
+            except:
+                logger.error("Failed to warm up %s", url, exc_info=True)
+
+
+def get_asset_cache(config):
+    return AssetCache(
+        config.get('PRINT_ASSET_CACHE_DIR') or os.path.join(config['DATA_DIRECTORY'], 'print-cache'),
+        max_bytes=config.get('PRINT_ASSET_CACHE_MAX_BYTES', 10 * 1024 * 1024),
+        revalidate_after=config.get('PRINT_ASSET_REVALIDATE', 300),
+    )
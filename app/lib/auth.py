@@ -3,11 +3,27 @@ import functools
 from flask import session, flash, redirect, url_for, g
 
 from app.database import RuntimeConfig, Device
+from app.lib.cache import SharedValue
+
+
+def _load_config():
+    res = RuntimeConfig.all_detached()
+    return res[0] if res else RuntimeConfig()
+
+
+def _load_devices():
+    # The first of any duplicates wins, like Device.get_by_devid
+    return {d.device_id: d for d in reversed(Device.all_detached())}
+
+
+# Read on every request, and only changed from the admin pages
+runtime_config = SharedValue('config', _load_config)
+devices = SharedValue('devices', _load_devices)
 
 
 def login(type_, password):
     house_disabled = False
-    config = RuntimeConfig.get_single()
+    config = runtime_config.get()
     check_password = getattr(config, type_ + '_pass', None)
     if check_password:
         if password == check_password:
@@ -23,7 +39,7 @@ def get_device(prop=None):
         g.current_device = False
         devid = session.get('device_id')
         if devid:
-            dev = Device.get_by_devid(devid)
+            dev = devices.get().get(devid)
             if dev:
                 g.current_device = dev
 
@@ -46,7 +62,7 @@ def require_login(admin=False):
     def require_login_impl(callback):
         @functools.wraps(callback)
         def require_login_wrapper(*args, **kwargs):
-            config = RuntimeConfig.get_single()
+            config = runtime_config.get()
             if admin and config.admin_pass and not session.get('login_admin'):
                 flash("Admin login is required", 'danger')
                 return redirect(url_for('auth.index', type_='admin'))
@@ -0,0 +1,74 @@
+import threading
+import time
+
+from flask import current_app
+
+from app.database import Counter
+
+
+class GenerationCache:
+    """Process-local cache of values built from the database.
+
+    Each value is stored with the generation counter it was built at and is
+    rebuilt once the counter has moved on, so a write in any process
+    invalidates every other process's copy without any messaging.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key, generation, build):
+        """The value for ``key`` at ``generation``, calling ``build()`` if it's missing or stale"""
+        key = (current_app.config['DATA_DIRECTORY'], key)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry[0] == generation:
+            return entry[1]
+
+        value = build()
+        with self.lock:
+            self.entries[key] = (generation, value)
+        return value
+
+
+class SharedValue:
+    """A process-wide value built from the database, for the hot path.
+
+    Like GenerationCache, but the generation counter is only read again
+    once ``ttl`` seconds have passed, so most uses don't touch storage at
+    all.  Writes from other processes show up within ``ttl``; writes from
+    this process bump the counter locally and show up immediately.
+    """
+
+    def __init__(self, name, build, ttl=2):
+        self.name = name
+        self.build = build
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self):
+        key = current_app.config['DATA_DIRECTORY']
+        local = Counter.local_value(self.name)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry[2] == local and now - entry[1] < self.ttl:
+            return entry[3]
+
+        generation = Counter.get_value(self.name)
+        if entry and entry[0] == generation:
+            value = entry[3]
+        else:
+            value = self.build()
+        with self.lock:
+            self.entries[key] = (generation, now, local, value)
+        return value
+
+
+rendered = GenerationCache()
+
+
+def generation(name):
+    return Counter.get_value(name)
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from PIL import Image, features
+
+
+logger = logging.getLogger(__name__)
+
+
+# Square derivatives are padded out to a square before resizing, others
+# keep their aspect ratio and fit within size x size
+DEFAULT_DERIVATIVES = {
+    'thumb': {'size': 50, 'square': True},
+    'tile': {'size': 144, 'square': True},
+    'receipt': {'size': 384, 'square': False},
+}
+DEFAULT_DERIVATIVE = 'tile'
+
+FORMATS = [('webp', 'WEBP'), ('png', 'PNG')]
+
+
+def get_derivatives(config=None):
+    config = config or current_app.config
+    return config.get('IMAGE_DERIVATIVES') or DEFAULT_DERIVATIVES
+
+
+def get_formats():
+    return [(ext, fmt) for ext, fmt in FORMATS if ext != 'webp' or features.check('webp')]
+
+
+def image_path(data_dir, name):
+    return os.path.join(data_dir, 'images', name)
+
+
+def derivative_path(data_dir, name, derivative, ext):
+    return os.path.join(data_dir, 'images', 'resized', derivative, os.path.splitext(name)[0] + '.' + ext)
+
+
+def image_version(name, mode):
+    """A short hash that changes whenever the file behind a URL could.
+
+    Image names are UUIDs that are never reused for another upload, so only
+    the derivative's spec needs to be mixed in.
+    """
+    spec = get_derivatives().get(mode) if mode != 'full' else None
+    key = json.dumps([name, mode, spec], sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:10]
+
+
+def _write_atomic(dirname, save):
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            save(fp)
+        # mkstemp only gives the owner access
+        os.chmod(tmp, 0o644)
+        return tmp
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def generate_derivatives(data_dir, name, derivatives, force=False):
+    """Write every derivative of an image that doesn't exist yet.
+
+    Each file is written to a temporary file and renamed into place, so a
+    partially written image is never served, and processes racing to write
+    the same derivative just replace each other's identical output.
+    """
+    img = None
+    for derivative, spec in derivatives.items():
+        for ext, fmt in get_formats():
+            outfile = derivative_path(data_dir, name, derivative, ext)
+            if os.path.exists(outfile) and not force:
+                continue
+
+            if img is None:
+                img = Image.open(image_path(data_dir, name))
+                img = img.convert('RGBA')
+
+            if spec.get('square'):
+                w, h = img.size
+                sz = max(w, h)
+                out = Image.new('RGBA', (sz, sz), (0, 0, 0, 0))
+                out.paste(img, (int((sz - w)), 0))
+                out = out.resize((spec['size'], spec['size']), Image.LANCZOS)
+            else:
+                out = img.copy()
+                out.thumbnail((spec['size'], spec['size']), Image.LANCZOS)
+
+            tmp = _write_atomic(os.path.dirname(outfile), lambda fp: out.save(fp, fmt, quality=70))
+            os.replace(tmp, outfile)
+
+
+def delete_derivatives(data_dir, name, derivatives):
+    for derivative in derivatives:
+        for ext, _ in FORMATS:
+            filename = derivative_path(data_dir, name, derivative, ext)
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = set()
+
+
+def _generate_logged(data_dir, name, derivatives):
+    try:
+        generate_derivatives(data_dir, name, derivatives)
+    except:
+        logger.error("Failed to generate derivatives of %s", name, exc_info=True)
+    finally:
+        with _executor_lock:
+            _pending.discard((data_dir, name))
+
+
+def schedule_derivatives(name):
+    """Generate an image's derivatives in the background"""
+    global _executor
+    data_dir = current_app.config['DATA_DIRECTORY']
+    with _executor_lock:
+        if (data_dir, name) in _pending:
+            return
+        _pending.add((data_dir, name))
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=current_app.config.get('IMAGE_WORKERS', 2), thread_name_prefix='images')
+        _executor.submit(_generate_logged, data_dir, name, dict(get_derivatives()))
+
+
+def save_image_atomic(name, save):
+    """Write a new original image with ``save(fp)``, then queue its derivatives"""
+    data_dir = current_app.config['DATA_DIRECTORY']
+    filename = image_path(data_dir, name)
+    tmp = _write_atomic(os.path.dirname(filename), save)
+    os.replace(tmp, filename)
+    schedule_derivatives(name)
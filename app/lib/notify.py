@@ -0,0 +1,76 @@
+import logging
+import os
+import socket
+import uuid
+
+from flask import current_app
+
+
+logger = logging.getLogger(__name__)
+
+
+def _channel_dir(channel):
+    dirname = os.path.join(current_app.config['DATA_DIRECTORY'], 'run', channel)
+    os.makedirs(dirname, exist_ok=True)
+    return dirname
+
+
+class Subscription:
+    """A datagram socket that receives everything published to a channel.
+
+    Each subscriber binds its own socket in the channel's directory, and
+    publishing sends to every socket found there, so this works across
+    uwsgi worker processes without any broker.
+    """
+
+    def __init__(self, channel):
+        self.path = os.path.join(_channel_dir(channel), f'{os.getpid()}-{uuid.uuid4().hex[:8]}.sock')
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+
+    def wait(self, timeout=None):
+        """Wait for a message, returns None if the timeout expires first"""
+        self.sock.settimeout(timeout)
+        try:
+            return self.sock.recv(65536)
+        except socket.timeout:
+            return None
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def subscribe(channel):
+    return Subscription(channel)
+
+
+def publish(channel, message=b''):
+    dirname = _channel_dir(channel)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    # Never block the publisher on a slow subscriber
+    sock.setblocking(False)
+    try:
+        for name in os.listdir(dirname):
+            path = os.path.join(dirname, name)
+            try:
+                sock.sendto(message, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a process that died without closing its subscription
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                logger.warning("Subscriber %s on %s is not keeping up", name, channel)
+    finally:
+        sock.close()
@@ -0,0 +1,48 @@
+import json
+import logging
+
+from flask import render_template, has_request_context
+
+from app.database import Drink, DrinkComponent, Counter
+from app.lib import notify
+
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'orders'
+
+CREATED = 'created'
+PRINTED = 'printed'
+COMPLETED = 'completed'
+DELETED = 'deleted'
+
+
+def render_row(order):
+    return render_template(
+        'admin/order_row.jinja.html',
+        o=order,
+        get_drink=Drink.get,
+        get_components=DrinkComponent.get_many,
+    )
+
+
+def publish(event, order_id, order=None):
+    """Tell every open orders page about a change to an order.
+
+    The row is rendered here, once, rather than by each subscriber.  Orders
+    bump the 'orders' generation on every write, which the stream sends as
+    the event id so a reconnecting page can tell whether it missed anything.
+    """
+    message = {
+        'event': event,
+        'id': order_id,
+        'generation': Counter.get_value('orders'),
+        'html': None,
+    }
+    if order is not None and has_request_context():
+        message['html'] = render_row(order)
+    try:
+        notify.publish(CHANNEL, json.dumps(message).encode('utf-8'))
+    except OSError:
+        # The page can catch up on its own, never fail the change itself over this
+        logger.warning("Failed to publish %s for order %s", event, order_id, exc_info=True)
@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+have_aiohttp = False
+try:
+    import aiohttp
+    have_aiohttp = True
+except ImportError:
+    pass
+
+from app.lib import serializer
+from app.lib.printer import get_printer, print_order
+
+
+logger = logging.getLogger(__name__)
+
+
+def backoff_delay(attempt, base=0.5, cap=60, rand=random):
+    """Seconds to wait before retry number ``attempt`` (from 1), with full jitter.
+
+    Spreading the retries out keeps several agents from hitting a server
+    that has just come back all at the same moment.
+    """
+    return rand.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class _RetryableError(Exception):
+    pass
+
+
+class PrinterState:
+    """One printer run by the agent, and its throughput so far"""
+
+    def __init__(self, printer_config):
+        self.printer_config = printer_config
+        self.params = {
+            'worker': f'{socket.gethostname()}-{os.getpid()}-{printer_config["name"]}',
+            'printer': printer_config['name'],
+        }
+        # Printers are driven one call at a time, but each gets its own
+        # thread so a slow printer doesn't hold up the others
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='print-' + printer_config['name'])
+        self.printer = None
+        self.printed = 0
+        self.failed = 0
+        self.print_time = 0
+        self.running = False
+
+
+class AsyncPrintAgent:
+    """Takes jobs for several printers from the API in one event loop.
+
+    All requests go through one ``aiohttp`` session, so polls and acks reuse
+    kept-alive connections.  Each printer claims up to ``batch_size`` jobs
+    per poll, and acks them all in one request once they've printed.  It
+    polls for more without waiting for the server to acknowledge that:
+    acks are sent in the background, and retried if they fail.  Printing
+    itself runs in a thread per printer, since the printer libraries block.
+    """
+
+    def __init__(self, api_url, printer_configs, assets=None, batch_size=10, poll_timeout=10, backoff_base=0.5, backoff_cap=60, ack_attempts=5):
+        self.api_url = api_url
+        self.url = api_url + '/print/jobs'
+        self.batch_size = batch_size
+        self.printers = [PrinterState(p) for p in printer_configs]
+        self.assets = assets
+        self.poll_timeout = poll_timeout
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.ack_attempts = ack_attempts
+        self.session = None
+        # Prints and acks in progress, which are finished before stopping
+        self.pending = set()
+        # Created by run(), in the loop it runs in: before Python 3.10 asyncio
+        # primitives bind to the current loop when they're made, and the CLI
+        # builds the agent before asyncio.run() starts one
+        self.stopping = None
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+        if self.stopping is not None:
+            self.stopping.set()
+
+    async def run(self, report_interval=None):
+        self.stopping = asyncio.Event()
+        if self.stopped:
+            self.stopping.set()
+        connector = aiohttp.TCPConnector(limit_per_host=len(self.printers) * 2 + 2, keepalive_timeout=60)
+        # Polls are held open by the server for up to poll_timeout
+        timeout = aiohttp.ClientTimeout(sock_connect=10, sock_read=self.poll_timeout + 20)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, json_serialize=serializer.dumps) as session:
+            self.session = session
+            await self._warm_assets()
+            tasks = [asyncio.create_task(self._run_printer(p)) for p in self.printers]
+            if report_interval:
+                tasks.append(asyncio.create_task(self._report(report_interval)))
+            try:
+                await self.stopping.wait()
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                # Jobs that printed have to be acked, or they'll print again
+                # once their lease runs out
+                while self.pending:
+                    await asyncio.gather(*self.pending, return_exceptions=True)
+        for p in self.printers:
+            p.executor.shutdown()
+
+    async def _request(self, method, url, params, json=None):
+        async with self.session.request(method, url, params=params, json=json) as res:
+            if res.status >= 500:
+                raise _RetryableError(f"{method} {url}: {res.status}")
+            res.raise_for_status()
+            return (await res.json(loads=serializer.loads))['result']
+
+    async def _warm_assets(self):
+        if self.assets is None:
+            return
+        try:
+            urls = await self._request('GET', self.api_url + '/print/assets', {})
+        except Exception:
+            logger.error("Failed to get the list of assets to warm up", exc_info=True)
+            urls = []
+        await asyncio.get_running_loop().run_in_executor(None, self.assets.warm, urls)
+
+    async def _run_printer(self, p):
+        loop = asyncio.get_running_loop()
+        failures = 0
+        p.running = True
+        try:
+            while not self.stopping.is_set():
+                try:
+                    if p.printer is None:
+                        p.printer = await loop.run_in_executor(p.executor, get_printer, p.printer_config)
+
+                    logger.debug("Get queued: %s %s", self.url, p.params)
+                    jobs = await self._request('GET', self.url, dict(p.params, timeout=self.poll_timeout, max=self.batch_size))
+                    failures = 0
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    failures += 1
+                    delay = backoff_delay(failures, self.backoff_base, self.backoff_cap)
+                    logger.error("Failed to get the print job, retrying in %.1fs", delay, exc_info=True)
+                    await asyncio.sleep(delay)
+                    continue
+                if not jobs:
+                    # There's no print job, just continue
+                    continue
+
+                # Once claimed, the jobs are printed and acked even if the agent is stopping
+                await asyncio.shield(self._track(self._print(p, jobs)))
+        finally:
+            p.running = False
+
+    async def _print(self, p, jobs):
+        loop = asyncio.get_running_loop()
+        results = []
+        for job in jobs:
+            t = time.time()
+            try:
+                logger.debug("Printing job on %s: %s", p.printer_config['name'], job)
+                await loop.run_in_executor(p.executor, print_order, p.printer, job, p.printer_config, self.assets)
+            except Exception:
+                logger.error("Failed to print", exc_info=True)
+                p.failed += 1
+                # Put it back so it can be retried
+                results.append({'id': job['id'], 'result': 'failed'})
+            else:
+                p.printed += 1
+                results.append({'id': job['id'], 'result': 'printed'})
+            finally:
+                p.print_time += time.time() - t
+
+        # The next poll doesn't wait for this
+        self._track(self._ack(p, results))
+
+    def _track(self, coro):
+        task = asyncio.create_task(coro)
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+        return task
+
+    async def _ack(self, p, results):
+        for attempt in range(1, self.ack_attempts + 1):
+            try:
+                logger.debug("Inform api jobs are done: %s", results)
+                not_held = await self._request('POST', self.url, p.params, json=results)
+                if not_held:
+                    # Their leases ran out, and someone else may have printed them too
+                    logger.warning("Jobs %s were no longer held by %s", not_held, p.params['worker'])
+                return
+            except (_RetryableError, aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt < self.ack_attempts:
+                    await asyncio.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_cap))
+                    continue
+                logger.error("Failed to notify api jobs are done: %s", results, exc_info=True)
+            except Exception:
+                logger.error("Failed to notify api jobs are done: %s", results, exc_info=True)
+            return
+
+    async def _report(self, interval):
+        start = time.time()
+        while True:
+            await asyncio.sleep(interval)
+            minutes = (time.time() - start) / 60
+            for p in self.printers:
+                log_throughput(p.printer_config['name'], p.printed, p.failed, p.print_time, minutes, p.running)
+
+
+def log_throughput(name, printed, failed, print_time, minutes, running):
+    logger.info(
+        "%s: %d printed (%.1f/min), %d failed, %.2fs avg print time%s",
+        name,
+        printed,
+        printed / minutes,
+        failed,
+        print_time / max(1, printed + failed),
+        '' if running else ' [STOPPED]',
+    )
@@ -1,38 +1,106 @@
 import logging
-import re
 import time
-import uuid
 import os
-import tempfile
+import itertools
 
 from flask import current_app, url_for
 
 have_printer_imports = False
 try:
     from escpos import printer
-    import requests
     have_printer_imports = True
 except ImportError:
     pass
 
-from app.database import Order, Drink, DrinkComponent, RuntimeConfig
+from app.database import Order, Drink, DrinkComponent, PrintJob, Event, prefetch
+from app.lib import notify, order_events
+from app.lib.auth import runtime_config
+from app.lib.images import get_derivatives
 
 
 logger = logging.getLogger(__name__)
 
 
+# When there's no cutter, jobs are only printed shortly after they're queued
+UNCUT_JOB_MAX_AGE = 10
+
+
 class PrintError(Exception):
     pass
 
 
-def auto_cut():
-    if current_app.config.get('ESCPOS_PRINTER_HAS_CUTTER'):
-        for c in current_app.config.get('ESCPOS_PRINTER_FMT', []):
+def get_printer_configs(config=None):
+    """The configured printers, as a list of dicts.
+
+    Printers are listed in PRINTERS; settings missing from a printer fall
+    back to the ESCPOS_PRINTER_* keys.  Without PRINTERS, there is a single
+    printer named "default" configured by the ESCPOS_PRINTER_* keys alone.
+    """
+    config = config or current_app.config
+    defaults = {
+        'name': 'default',
+        'mode': config.get('ESCPOS_PRINTER_MODE'),
+        'id': config.get('ESCPOS_PRINTER_ID'),
+        'image_impl': config.get('ESCPOS_PRINTER_IMAGE_IMPL'),
+        'has_cutter': config.get('ESCPOS_PRINTER_HAS_CUTTER', False),
+        'fmt': config.get('ESCPOS_PRINTER_FMT', []),
+        # Routing rules, a printer with no rules takes any order
+        'events': None,
+        'drink_types': None,
+    }
+    return [dict(defaults, **p) for p in config.get('PRINTERS') or [{}]]
+
+
+def get_printer_config(name):
+    for p in get_printer_configs():
+        if p['name'] == name:
+            return p
+    return None
+
+
+def auto_cut(printer_config):
+    if printer_config.get('has_cutter'):
+        for c in printer_config.get('fmt', []):
             if c.get('command') == 'cut':
                 return True
     return False
 
 
+_round_robin = itertools.count()
+
+
+def route_order(order):
+    """Pick the printer for an order, returns its config"""
+    printers = get_printer_configs()
+    if len(printers) == 1:
+        return printers[0]
+
+    event = Event.get(order.event) if order.event else None
+    drink_type = 'menu' if order.drink else 'custom'
+
+    def _matches(p):
+        if p['events'] is not None and not (event and event.name in p['events']):
+            return False
+        if p['drink_types'] is not None and drink_type not in p['drink_types']:
+            return False
+        return True
+
+    candidates = list(filter(_matches, printers)) or printers
+    if len(candidates) == 1:
+        return candidates[0]
+
+    if current_app.config.get('PRINTER_ROUTING', 'least-busy') == 'round-robin':
+        # Per process, but with several workers the rotation still evens out
+        return candidates[next(_round_robin) % len(candidates)]
+
+    now = time.time()
+    busy = {p['name']: 0 for p in candidates}
+    for job in PrintJob.all():
+        if job.printer in busy and job.is_pending(now):
+            busy[job.printer] += 1
+    return min(candidates, key=lambda p: busy[p['name']])
+
+
 def queue_order_to_print(order=None, order_id=None, auto=False, force=False):
     if not order:
         if not order_id:
@@ -42,26 +110,66 @@ def queue_order_to_print(order=None, order_id=None, auto=False, force=False):
             raise PrintError("No such order")
 
     if force or not order.printed:
-        if not auto_cut():
+        printer_config = route_order(order)
+        if not auto_cut(printer_config):
             if auto:
                 # Called on order save - don't automatically print
                 return
-            for o in Order.find(custom_conds=[lambda q: q.print_queued > 0]):
-                if time.time() - o.print_queued < 10:
+            now = time.time()
+            for job in PrintJob.find(printer=printer_config['name']):
+                if job.is_pending(now) and now - job.created < UNCUT_JOB_MAX_AGE:
                     raise PrintError("A print job is already queued")
-        order.print_queued = time.time()
-        order.save()
+        PrintJob.enqueue(order.doc_id, printer=printer_config['name'], printable=order.printable)
+        # Wake up any print_job requests that are waiting for work
+        notify.publish('print')
 
     return order
 
 
-def get_queued_order():
-    for o in Order.find(custom_conds=[lambda q: q.print_queued > 0]):
-        if auto_cut() or time.time() - o.print_queued < 10:
-            return o
+def _claim_options(printer):
+    printer_config = get_printer_config(printer) if printer else get_printer_configs()[0]
+    if not printer_config:
+        raise PrintError("No such printer: " + printer)
+    return {
+        'printer': printer,
+        'lease': current_app.config.get('PRINT_JOB_LEASE', 30),
+        # Without a cutter, tickets have to be torn off by hand - don't print old ones
+        'max_age': None if auto_cut(printer_config) else UNCUT_JOB_MAX_AGE,
+        'max_attempts': current_app.config.get('PRINT_JOB_MAX_ATTEMPTS', 3),
+    }
+
+
+def claim_print_job(worker, printer=None):
+    """Claim the next print job for ``worker``, returns (job, order) or None"""
+    options = _claim_options(printer)
+    while True:
+        job = PrintJob.claim(worker, **options)
+        if not job:
+            return None
+        order = Order.get(job.order)
+        if order:
+            return job, order
+        # The order was deleted while it was queued
+        PrintJob.complete(job.doc_id, worker)
+
 
+def claim_print_jobs(worker, printer=None, max_jobs=10):
+    """Claim up to ``max_jobs`` print jobs for ``worker`` in one
+    transaction, returns a list of (job, order)"""
+    options = _claim_options(printer)
+    with PrintJob.transaction():
+        jobs = PrintJob.claim_many(worker, max_jobs, **options)
+        orders = {o.doc_id: o for o in Order.get_many([job.order for job in jobs])}
+        deleted = [job.doc_id for job in jobs if job.order not in orders]
+        if deleted:
+            # The orders were deleted while they were queued
+            PrintJob.delete_many(deleted)
+    return [(job, orders[job.order]) for job in jobs if job.order in orders]
 
-def get_order_printable(order):
+
+def build_order_printable(order):
+    """The parts of an order's ticket that come from the order itself,
+    with the drink and components resolved to names"""
     drink = None
     if order.drink:
         drink = Drink.get(order.drink)
@@ -72,14 +180,7 @@ def get_order_printable(order):
 
     strength = f' [{order.strength}]' if order.strength else ''
 
-    c = RuntimeConfig.get_single()
-    logo = None
-    if c.logo:
-        logo = url_for('index.images', name=c.logo, mode='full', _external=True)
-
     return {
-        'id': order.doc_id,
-        'logo': logo,
         'name': order.name,
         'drink_name': (order.drink_name + strength) if order.drink_name else None,
         'drink': (drink.name + strength) if drink else None,
@@ -87,62 +188,185 @@ def get_order_printable(order):
     }
 
 
-def clear_queued_order(order=None, order_id=None):
-    if not order:
-        if not order_id:
-            raise PrintError("Need an order or ID")
-        order = Order.get(order_id)
-        if not order:
-            raise PrintError("No such order")
-    order.printed = True
-    order.print_queued = 0
-    order.save()
-    return order.doc_id
-
-
-logo_cache = {}
-
-
-def print_order(printer, data):
-    if data.get('logo') and data['logo'] not in logo_cache:
-        fname = os.path.join(tempfile.gettempdir(), data['logo'].split('/')[-1])
-        res = requests.get(data['logo'], stream=True)
-        res.raise_for_status()
-        with open(fname, 'wb') as fp:
-            for chunk in res.iter_content(chunk_size=1024):
-                fp.write(chunk)
-        logo_cache[data['logo']] = fname
-
-    for c in current_app.config.get('ESCPOS_PRINTER_FMT', []):
-        if c['command'] == 'text':
-            printer.text(c['value'])
-        elif c['command'] == 'logo':
-            if current_app.config.get('ESCPOS_PRINTER_IMAGE_IMPL'):
-                if data.get('logo'):
-                    printer.image(
-                        logo_cache[data['logo']],
-                        impl=current_app.config['ESCPOS_PRINTER_IMAGE_IMPL']
-                    )
-        elif c['command'] == 'font':
-            args = {}
-            if c.get('align'):
-                args['align'] = c['align']
-            if c.get('size'):
-                args['width'], args['height'] = c['size']
-            printer.set(**args)
-        elif c['command'] in ('name', 'drink_name', 'drink', 'drink_components'):
-            if data.get(c['command']):
-                printer.text(data[c['command']] + '\n')
-        elif c['command'] == 'cut':
-            if current_app.config.get('ESCPOS_PRINTER_HAS_CUTTER'):
-                printer.cut(mode='PART' if c.get('partial') else 'FULL')
-
-
-def get_printer():
+def _stored_printable(order, job=None):
+    # The job's copy is dropped if the order is edited, along with the order's
+    return (job.printable if job else None) or order.printable
+
+
+def get_order_printable(order, job=None, logo=None):
+    printable = _stored_printable(order, job) or build_order_printable(order)
+    return dict(
+        printable,
+        id=job.doc_id if job else None,
+        order_id=order.doc_id,
+        # Not stored: the URL is built for the host the printer asked
+        logo=logo or get_logo_url(),
+    )
+
+
+def get_order_printables(jobs):
+    """get_order_printable() for each of a list of (job, order).  Orders
+    placed before printables were stored have their drinks and components
+    read in one go"""
+    orders = [order for job, order in jobs if not _stored_printable(order, job)]
+    prefetch(orders, 'drink', Drink)
+    prefetch(orders, 'drink_components', DrinkComponent)
+    logo = get_logo_url()
+    return [get_order_printable(order, job=job, logo=logo) for job, order in jobs]
+
+
+def get_logo_url():
+    c = runtime_config.get()
+    if c.logo:
+        return url_for('index.images', name=c.logo, mode='receipt' if 'receipt' in get_derivatives() else 'full', _external=True)
+    return None
+
+
+def get_print_assets():
+    return list(filter(None, [get_logo_url()]))
+
+
+def complete_print_job(job_id, worker=None):
+    job = PrintJob.complete(job_id, worker)
+    if not job:
+        raise PrintError("No such print job")
+    order = Order.get(job.order)
+    if order:
+        order.printed = True
+        order.save()
+        order_events.publish(order_events.PRINTED, order.doc_id, order)
+    return job.order
+
+
+PRINTED = 'printed'
+FAILED = 'failed'
+
+
+def finish_print_jobs(results, worker=None):
+    """Complete or release many print jobs in one transaction.
+
+    ``results`` maps job IDs to PRINTED, for jobs to complete, or FAILED,
+    for jobs to put back in the queue.  Returns the IDs of the jobs that
+    were no longer held by ``worker``, which were left alone.
+    """
+    printed = [job_id for job_id, result in results.items() if result == PRINTED]
+    failed = [job_id for job_id, result in results.items() if result == FAILED]
+    if len(printed) + len(failed) != len(results):
+        raise PrintError("Results must be one of: " + ', '.join([PRINTED, FAILED]))
+
+    with PrintJob.transaction():
+        jobs = PrintJob.complete_many(printed, worker)
+        released = PrintJob.release_many(failed, worker)
+        orders = Order.get_many([job.order for job in jobs], preserve_order=False)
+        Order.bulk_update({order.doc_id: {'printed': True} for order in orders})
+
+    for order in orders:
+        order.printed = True
+        order_events.publish(order_events.PRINTED, order.doc_id, order)
+    if released:
+        # Someone else may be able to print them
+        notify.publish('print')
+    done = {job.doc_id for job in jobs} | set(released)
+    return [job_id for job_id in results if job_id not in done]
+
+
+class ReceiptTemplate:
+    """A printer's receipt format, compiled to ESC/POS bytes.
+
+    Everything that's the same on every ticket (text, font changes, cuts) is
+    rendered once into byte buffers, leaving only the order's fields and the
+    logo to fill in.  The rasterized logo is kept too, for as long as the
+    logo file doesn't change.
+    """
+    FIELDS = ('name', 'drink_name', 'drink', 'drink_components')
+    LOGO = object()
+
+    def __init__(self, printer_config):
+        self.image_impl = printer_config.get('image_impl')
+        self.segments = []
+        self._logo = None
+
+        buf = printer.Dummy()
+
+        def _flush():
+            if buf.output:
+                self.segments.append(buf.output)
+                buf.clear()
+
+        for c in printer_config.get('fmt', []):
+            if c['command'] == 'text':
+                buf.text(c['value'])
+            elif c['command'] == 'logo':
+                if self.image_impl:
+                    _flush()
+                    self.segments.append(self.LOGO)
+            elif c['command'] == 'font':
+                args = {}
+                if c.get('align'):
+                    args['align'] = c['align']
+                if c.get('size'):
+                    args['width'], args['height'] = c['size']
+                buf.set(**args)
+            elif c['command'] in self.FIELDS:
+                _flush()
+                self.segments.append(c['command'])
+            elif c['command'] == 'cut':
+                if printer_config.get('has_cutter'):
+                    buf.cut(mode='PART' if c.get('partial') else 'FULL')
+        _flush()
+
+    def _get_logo(self, filename):
+        key = (filename, os.stat(filename).st_mtime_ns)
+        if self._logo is None or self._logo[0] != key:
+            buf = printer.Dummy()
+            buf.image(filename, impl=self.image_impl)
+            self._logo = (key, buf.output)
+        return self._logo[1]
+
+    def render(self, data, logo_filename=None):
+        out = []
+        for seg in self.segments:
+            if seg is self.LOGO:
+                if logo_filename:
+                    out.append(self._get_logo(logo_filename))
+            elif isinstance(seg, str):
+                if data.get(seg):
+                    # Each field gets a fresh encoder, which selects a code page if the text needs one
+                    buf = printer.Dummy()
+                    buf.text(data[seg] + '\n')
+                    out.append(buf.output)
+            else:
+                out.append(seg)
+        return b''.join(out)
+
+
+receipt_templates = {}
+
+
+def get_receipt_template(printer_config):
+    key = (printer_config['name'], repr(printer_config))
+    if key not in receipt_templates:
+        receipt_templates[key] = ReceiptTemplate(printer_config)
+    return receipt_templates[key]
+
+
+def print_order(printer, data, printer_config, assets=None):
+    # The logo is left off if it hasn't been downloaded yet, rather than holding up the ticket
+    logo_filename = None
+    if data.get('logo') and assets:
+        logo_filename = assets.get(data['logo'])
+
+    printer._raw(get_receipt_template(printer_config).render(data, logo_filename))
+
+
+def get_printer(printer_config):
     if not have_printer_imports:
         raise PrintError("Printer libraries are not installed")
 
-    if current_app.config.get('ESCPOS_PRINTER_MODE') == 'usb':
-        return printer.Usb(*current_app.config['ESCPOS_PRINTER_ID'])
+    if printer_config.get('mode') == 'usb':
+        return printer.Usb(*printer_config['id'])
+    elif printer_config.get('mode') == 'dummy':
+        # Discards everything, for testing
+        return printer.Dummy()
     else:
         raise PrintError("Invalid printer mode")
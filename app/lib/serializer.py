@@ -0,0 +1,73 @@
+import gc
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+have_orjson = False
+try:
+    import orjson
+    have_orjson = True
+except ImportError:
+    pass
+
+
+if have_orjson:
+    # Dict keys are converted like json does, and dates and dataclasses go
+    # to ``default`` so they come out the same with or without orjson
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+
+def dumps_bytes(obj, default=None, sort_keys=False):
+    """``obj`` as compact UTF-8 JSON"""
+    if have_orjson:
+        option = _OPTIONS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        try:
+            return orjson.dumps(obj, default=default, option=option)
+        except orjson.JSONEncodeError:
+            # Integers too large for 64 bits, among others, which json can
+            # still handle.  It raises its own error if it can't either
+            pass
+    return json.dumps(obj, default=default, sort_keys=sort_keys, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def dumps(obj, default=None, sort_keys=False):
+    return dumps_bytes(obj, default=default, sort_keys=sort_keys).decode('utf-8')
+
+
+# Parsing a whole database creates enough containers to set off several
+# full garbage collections, which take longer than the parsing itself.  A
+# freshly parsed document can't contain reference cycles, so there is
+# nothing for them to find
+GC_PAUSE_SIZE = 64 * 1024
+
+
+def _loads(data):
+    if have_orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def loads(data):
+    """Parse JSON from str or bytes, raising ValueError if it isn't valid"""
+    if len(data) < GC_PAUSE_SIZE or not gc.isenabled():
+        return _loads(data)
+    gc.disable()
+    try:
+        return _loads(data)
+    finally:
+        gc.enable()
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask's JSON handling (``jsonify``, ``request.json``) through this module."""
+
+    def dumps(self, obj, **kwargs):
+        if kwargs.get('indent') or kwargs.get('cls'):
+            # Pretty printed responses in debug mode
+            return super().dumps(obj, **kwargs)
+        return dumps(obj, default=kwargs.get('default', self.default), sort_keys=kwargs.get('sort_keys', self.sort_keys))
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return loads(s)
@@ -222,6 +222,41 @@
 
     };
 
+    window.enable_live_orders = function(url) {
+        if (!window.EventSource) {
+            window.enable_autorefresh();
+            return;
+        }
+
+        let source = new EventSource(url);
+
+        let reload = function() {
+            source.close();
+            window.location.reload();
+        };
+
+        let remove_row = function(id) {
+            document.querySelectorAll('tr[data-order-id="' + id + '"]').forEach((row) => row.remove());
+        };
+
+        let add_row = function(name, data) {
+            // Rows are only sent when the change was made in a request
+            if (!data.html) return reload();
+            remove_row(data.id);
+            document.querySelector('[data-orders="' + name + '"]').insertAdjacentHTML('beforeend', data.html);
+        };
+
+        source.addEventListener('created', (e) => add_row('queued', JSON.parse(e.data)));
+        source.addEventListener('printed', (e) => add_row('printed', JSON.parse(e.data)));
+        source.addEventListener('completed', function(e) {
+            remove_row(JSON.parse(e.data).id);
+            document.querySelectorAll('[data-orders-served]').forEach((ele) => ele.innerText = parseInt(ele.innerText) + 1);
+        });
+        source.addEventListener('deleted', (e) => remove_row(JSON.parse(e.data).id));
+        // Sent when the page missed something, while loading or reconnecting
+        source.addEventListener('reload', reload);
+    };
+
     $('.order-form form').on('submit', function(e) {
         $('.order-form [type=submit]')
             .attr('disabled', 'disabled')
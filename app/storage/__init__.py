@@ -0,0 +1,111 @@
+import os
+
+from tinydb import Query
+
+
+class StorageError(Exception):
+    pass
+
+
+class Backend:
+    """A document store, holding one table of documents per model.
+
+    Documents are returned as ``tinydb.table.Document`` instances (a dict
+    with a ``doc_id``) no matter which backend is in use.
+    """
+
+    def table(self, name, indexes=()):
+        raise NotImplementedError()
+
+    def tables(self):
+        raise NotImplementedError()
+
+    def transaction(self):
+        """Context manager that excludes all other writers, in this and in
+        other processes, until it exits.  May be nested.  Writes made in it
+        are stored together when the outermost one exits, or discarded if
+        it exits with an exception."""
+        raise NotImplementedError()
+
+    def compact(self):
+        """Rewrite the store to give back the space left by removed documents."""
+        pass
+
+    def close(self):
+        pass
+
+
+class Table:
+    def get(self, doc_id):
+        raise NotImplementedError()
+
+    def get_many(self, doc_ids):
+        """Documents for each of ``doc_ids`` that exists, in any order."""
+        raise NotImplementedError()
+
+    def all(self):
+        raise NotImplementedError()
+
+    def search(self, filters=None, cond=None, limit=None):
+        """Find documents where every key in ``filters`` equals its value,
+        and that match ``cond`` (a TinyDB query) if given.  They come in
+        the order they were inserted, and only the first ``limit`` of them
+        are read if it's given."""
+        raise NotImplementedError()
+
+    def insert(self, data, doc_id=None):
+        raise NotImplementedError()
+
+    def update(self, data, doc_id):
+        raise NotImplementedError()
+
+    def update_many(self, changes):
+        """Apply ``{doc_id: data}`` as one write, skipping missing documents."""
+        raise NotImplementedError()
+
+    def remove(self, doc_id):
+        raise NotImplementedError()
+
+    def truncate(self):
+        raise NotImplementedError()
+
+
+def build_query(filters=None, cond=None):
+    query = Query()
+    search = cond
+    for k, v in (filters or {}).items():
+        c = getattr(query, k) == v
+        search = c if search is None else search & c
+    return search
+
+
+BACKENDS = {
+    'json': ('app.storage.tinydb_backend', 'TinyDBBackend', 'db.json'),
+    'sqlite': ('app.storage.sqlite_backend', 'SQLiteBackend', 'db.sqlite3'),
+    'log': ('app.storage.log_backend', 'LogBackend', 'db.log'),
+}
+
+
+def get_backend_class(name):
+    try:
+        module_name, cls_name, _ = BACKENDS[name]
+    except KeyError:
+        raise StorageError("Invalid database backend: " + str(name))
+    module = __import__(module_name, fromlist=[cls_name])
+    return getattr(module, cls_name)
+
+
+def get_filename(config, name=None):
+    name = name or config.get('DATABASE_BACKEND', 'json')
+    try:
+        dfl_filename = BACKENDS[name][2]
+    except KeyError:
+        raise StorageError("Invalid database backend: " + str(name))
+    return os.path.join(config['DATA_DIRECTORY'], dfl_filename)
+
+
+def open_backend(config, name=None):
+    name = name or config.get('DATABASE_BACKEND', 'json')
+    # Backend specific settings, e.g. sync_interval for the log backend
+    options = config.get('DATABASE_OPTIONS', {}).get(name, {})
+    return get_backend_class(name)(get_filename(config, name), **options)
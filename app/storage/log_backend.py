@@ -0,0 +1,453 @@
+import os
+import time
+import zlib
+import itertools
+import fcntl
+import tempfile
+import threading
+import contextlib
+
+from tinydb.table import Document
+
+from app.lib import serializer
+
+from . import Backend, Table, StorageError, build_query
+from .tinydb_backend import _hashable, _FieldIndex
+
+
+def _encode(record):
+    payload = serializer.dumps_bytes(record)
+    return b'%08x %s\n' % (zlib.crc32(payload), payload)
+
+
+def _decode(line):
+    """The record in one line of the log, or None if it's torn or corrupt"""
+    if len(line) < 10 or line[8:9] != b' ' or not line.endswith(b'\n'):
+        return None
+    payload = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(payload):
+            return None
+        return serializer.loads(payload)
+    except ValueError:
+        return None
+
+
+def _fsync_dir(dirname):
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _LogState:
+    """Per-process copy of the database and position in its log, shared by threads."""
+
+    def __init__(self, name):
+        self.name = name
+        self.pid = os.getpid()
+        self.rlock = threading.RLock()
+        self.lock_fd = os.open(name + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        self.depth = 0
+        # {table: {doc_id: doc}}, None until the snapshot and log are read
+        self.tables = None
+        # The ID given to the next document inserted into each table
+        self.next_ids = {}
+        self.log_fd = None
+        self.log_ino = None
+        self.epoch = 0
+        # Bytes of the log that have been applied to ``tables``
+        self.offset = 0
+        # Records written in the current transaction, stored when it exits
+        self.pending = []
+        # {table: {field: _FieldIndex}}, built on first use and kept up to
+        # date as operations are applied
+        self.indexes = {}
+        self.unsynced = False
+        self.last_sync = 0
+        self.sync_timer = None
+
+
+class LogBackend(Backend):
+    """Keeps the database in memory, storing changes in an append-only log.
+
+    Every transaction is appended to ``<db>.log`` as one line, holding a
+    CRC-32 of the line's JSON so a write torn by a crash or power cut is
+    recognised and dropped on the next open: a transaction is either in the
+    log whole or not at all.  Writing costs the size of the change, rather
+    than the size of the database.
+
+    The log is folded into ``<db>.log.snapshot`` once it grows past
+    ``checkpoint_bytes``.  The snapshot and the new, empty log are written
+    to temporary files, synced and renamed into place, and both carry an
+    epoch number so a crash between the two renames can't replay the old
+    log on top of the new snapshot.
+
+    Like the JSON backend, writers are serialized by an ``flock`` on
+    ``<db>.lock`` and each process keeps its own copy of the data, reading
+    only what other processes have appended since.  The log is synced
+    before each transaction returns, or with ``sync_interval`` set, at most
+    that many seconds later, which batches the syncs of busy writers at the
+    cost of losing the last moments of writes (never their consistency) in
+    a power cut.
+    """
+    states = {}
+    states_lock = threading.Lock()
+
+    def __init__(self, filename, sync_interval=0, checkpoint_bytes=4 * 1024 * 1024):
+        self.name = filename
+        self.snapshot_name = filename + '.snapshot'
+        self.sync_interval = sync_interval
+        self.checkpoint_bytes = checkpoint_bytes
+        self._tables = {}
+
+    @property
+    def state(self):
+        with self.states_lock:
+            state = self.states.get(self.name)
+            # A forked child shares the parent's open lock file, which would
+            # also share the flock - it needs its own
+            if state is None or state.pid != os.getpid():
+                state = self.states[self.name] = _LogState(self.name)
+            return state
+
+    # Reading
+
+    def _load(self, state):
+        """Read the snapshot and replay the whole log, with the lock held"""
+        try:
+            with open(self.snapshot_name, 'rb') as fp:
+                snapshot = serializer.loads(fp.read())
+        except FileNotFoundError:
+            snapshot = {'epoch': 0, 'tables': {}}
+        except ValueError as e:
+            raise StorageError(f"{self.snapshot_name} is corrupt: {e}")
+
+        self._remove_temporary()
+        state.tables = {
+            name: {int(doc_id): doc for doc_id, doc in docs.items()}
+            for name, docs in snapshot['tables'].items()
+        }
+        state.next_ids = {name: max(docs, default=0) + 1 for name, docs in state.tables.items()}
+        state.epoch = snapshot['epoch']
+        state.indexes = {}
+        self._open_log(state)
+
+        first = os.pread(state.log_fd, 4096, 0)
+        header = _decode(first.split(b'\n', 1)[0] + b'\n')
+        if not first or (header is not None and header.get('epoch', -1) < state.epoch):
+            # A new database, or a log left over from before the last
+            # checkpoint, which was interrupted before the new log replaced it
+            self._new_log(state)
+            return
+        if header is None or header.get('epoch') != state.epoch:
+            raise StorageError(f"{self.name} does not belong to {self.snapshot_name}")
+        state.offset = len(_encode(header))
+        self._replay(state)
+
+    def _remove_temporary(self):
+        # Left behind by a checkpoint that crashed before its rename
+        dirname, basename = os.path.split(os.path.abspath(self.name))
+        for name in os.listdir(dirname):
+            if name.startswith('.' + basename):
+                os.unlink(os.path.join(dirname, name))
+
+    def _open_log(self, state):
+        if state.log_fd is not None:
+            os.close(state.log_fd)
+        state.log_fd = os.open(self.name, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        state.log_ino = os.fstat(state.log_fd).st_ino
+        state.offset = 0
+
+    def _replay(self, state):
+        """Apply whatever has been appended to the log since ``state.offset``"""
+        size = os.fstat(state.log_fd).st_size
+        if size <= state.offset:
+            return
+        data = os.pread(state.log_fd, size - state.offset, state.offset)
+        pos = 0
+        while pos < len(data):
+            end = data.find(b'\n', pos)
+            line = data[pos:] if end < 0 else data[pos:end + 1]
+            record = _decode(line)
+            if record is None:
+                if end >= 0 and data[end + 1:].strip():
+                    raise StorageError(f"{self.name} is corrupt at byte {state.offset + pos}")
+                # The tail of a write that never finished.  Writers hold the
+                # lock, as does this, so nobody is still writing it
+                os.ftruncate(state.log_fd, state.offset + pos)
+                break
+            for op in record:
+                self._apply(state, op)
+            pos += len(line)
+        state.offset += pos
+
+    def _refresh(self, state):
+        """Bring this process's copy up to date with the log, with the lock held"""
+        if state.tables is None:
+            self._load(state)
+            return
+        try:
+            ino = os.stat(self.name).st_ino
+        except FileNotFoundError:
+            ino = None
+        if ino != state.log_ino:
+            # Another process has checkpointed
+            self._load(state)
+        else:
+            self._replay(state)
+
+    def _is_current(self, state):
+        if state.tables is None:
+            return False
+        try:
+            st = os.stat(self.name)
+        except FileNotFoundError:
+            return False
+        return st.st_ino == state.log_ino and st.st_size == state.offset
+
+    @contextlib.contextmanager
+    def reading(self):
+        """The current data, read under the lock only if it has changed"""
+        state = self.state
+        with state.rlock:
+            if not state.depth and not self._is_current(state):
+                with self.transaction():
+                    pass
+            yield state.tables
+
+    # Writing
+
+    @staticmethod
+    def _apply(state, op):
+        kind, table = op[0], op[1]
+        docs = state.tables.setdefault(table, {})
+        indexes = state.indexes.get(table, {})
+        if kind == 'insert':
+            docs[op[2]] = op[3]
+            state.next_ids[table] = max(state.next_ids.get(table, 1), op[2] + 1)
+            for index in indexes.values():
+                index.remove(op[2])
+                index.add(op[2], op[3])
+        elif kind == 'update':
+            if op[2] in docs:
+                docs[op[2]] = dict(docs[op[2]], **op[3])
+                for index in indexes.values():
+                    if index.field in op[3]:
+                        index.remove(op[2])
+                        index.add(op[2], docs[op[2]])
+        elif kind == 'remove':
+            docs.pop(op[2], None)
+            for index in indexes.values():
+                index.remove(op[2])
+        elif kind == 'truncate':
+            docs.clear()
+            state.indexes.pop(table, None)
+        elif kind == 'drop':
+            del state.tables[table]
+            state.next_ids.pop(table, None)
+            state.indexes.pop(table, None)
+        else:
+            raise StorageError(f"Unknown operation in {state.name}: {kind}")
+
+    def write(self, *op):
+        """Apply ``op`` now, and store it when the transaction exits"""
+        with self.transaction() as state:
+            # Stored as it will be read back, so nothing the caller still
+            # holds can change it
+            op = serializer.loads(serializer.dumps_bytes(op))
+            self._apply(state, op)
+            state.pending.append(op)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        state = self.state
+        with state.rlock:
+            if not state.depth:
+                fcntl.flock(state.lock_fd, fcntl.LOCK_EX)
+            state.depth += 1
+            try:
+                if state.depth == 1:
+                    self._refresh(state)
+                yield state
+                if state.depth == 1 and state.pending:
+                    self._commit(state)
+            except:
+                if state.depth == 1 and state.pending:
+                    # Changes were applied as they were made, read everything again
+                    state.pending = []
+                    state.tables = None
+                raise
+            finally:
+                state.depth -= 1
+                if not state.depth:
+                    fcntl.flock(state.lock_fd, fcntl.LOCK_UN)
+
+    def _commit(self, state):
+        line = _encode(state.pending)
+        state.pending = []
+        try:
+            written = os.write(state.log_fd, line)
+            if written != len(line):
+                raise StorageError(f"Short write to {self.name}")
+        except:
+            state.tables = None
+            raise
+        state.offset += len(line)
+        self._sync(state)
+        if state.offset > self.checkpoint_bytes:
+            self._checkpoint(state)
+
+    def _sync(self, state):
+        if not self.sync_interval or time.monotonic() - state.last_sync >= self.sync_interval:
+            os.fsync(state.log_fd)
+            state.unsynced = False
+            state.last_sync = time.monotonic()
+            return
+        state.unsynced = True
+        if state.sync_timer is None:
+            state.sync_timer = threading.Timer(self.sync_interval, self._sync_later, (state,))
+            state.sync_timer.daemon = True
+            state.sync_timer.start()
+
+    def _sync_later(self, state):
+        with state.rlock:
+            state.sync_timer = None
+            if state.unsynced and state.pid == os.getpid():
+                os.fsync(state.log_fd)
+                state.unsynced = False
+                state.last_sync = time.monotonic()
+
+    # Checkpoints
+
+    def _write_atomic(self, filename, data):
+        dirname = os.path.dirname(os.path.abspath(filename))
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(filename) + '-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, filename)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        _fsync_dir(dirname)
+
+    def _new_log(self, state):
+        self._write_atomic(self.name, _encode({'epoch': state.epoch}))
+        self._open_log(state)
+        state.offset = os.fstat(state.log_fd).st_size
+
+    def _checkpoint(self, state):
+        """Fold the log into a new snapshot, with the lock held"""
+        try:
+            self._write_checkpoint(state, state.epoch + 1)
+        except:
+            # Whatever made it to disk is consistent, start again from that
+            state.tables = None
+            raise
+
+    def _write_checkpoint(self, state, epoch):
+        snapshot = {
+            'epoch': epoch,
+            'tables': {
+                name: {str(doc_id): doc for doc_id, doc in docs.items()}
+                for name, docs in state.tables.items()
+            },
+        }
+        self._write_atomic(self.snapshot_name, serializer.dumps_bytes(snapshot))
+        state.epoch = epoch
+        self._new_log(state)
+
+    # Backend
+
+    def table(self, name, indexes=()):
+        if name not in self._tables:
+            self._tables[name] = LogTable(self, name, indexes=indexes)
+        return self._tables[name]
+
+    def tables(self):
+        with self.reading() as tables:
+            return sorted(tables)
+
+    def compact(self):
+        with self.transaction() as state:
+            for name in [name for name, docs in state.tables.items() if not docs]:
+                self.write('drop', name)
+        with self.transaction() as state:
+            self._checkpoint(state)
+
+    def close(self):
+        # The data and the log stay open for the next request in this process
+        pass
+
+
+class LogTable(Table):
+    def __init__(self, backend, name, indexes=()):
+        self.backend = backend
+        self.name = name
+        self.indexes = tuple(indexes)
+
+    def _index(self, state, docs, field):
+        indexes = state.indexes.setdefault(self.name, {})
+        if field not in indexes:
+            indexes[field] = _FieldIndex(field, docs.items())
+        return indexes[field]
+
+    def get(self, doc_id):
+        with self.backend.reading() as tables:
+            doc = tables.get(self.name, {}).get(doc_id)
+            return None if doc is None else Document(doc, doc_id=doc_id)
+
+    def get_many(self, doc_ids):
+        with self.backend.reading() as tables:
+            docs = tables.get(self.name, {})
+            return [Document(docs[doc_id], doc_id=doc_id) for doc_id in doc_ids if doc_id in docs]
+
+    def all(self):
+        with self.backend.reading() as tables:
+            return [Document(doc, doc_id=doc_id) for doc_id, doc in tables.get(self.name, {}).items()]
+
+    def search(self, filters=None, cond=None, limit=None):
+        query = build_query(filters, cond)
+        fields = [k for k in self.indexes if k in (filters or {}) and _hashable(filters[k])]
+        with self.backend.reading() as tables:
+            docs = tables.get(self.name, {})
+            if fields:
+                state = self.backend.state
+                doc_ids = min((self._index(state, docs, f).get(filters[f]) for f in fields), key=len)
+            else:
+                doc_ids = docs
+            res = (Document(docs[doc_id], doc_id=doc_id) for doc_id in doc_ids)
+            if query is not None:
+                res = (doc for doc in res if query(doc))
+            return list(itertools.islice(res, limit))
+
+    def insert(self, data, doc_id=None):
+        with self.backend.transaction() as state:
+            if doc_id is None:
+                doc_id = state.next_ids.get(self.name, 1)
+            elif doc_id in state.tables.get(self.name, {}):
+                raise ValueError(f"Document with ID {doc_id} already exists")
+            self.backend.write('insert', self.name, doc_id, dict(data))
+            return doc_id
+
+    def update(self, data, doc_id):
+        self.update_many({doc_id: data})
+
+    def update_many(self, changes):
+        with self.backend.transaction() as state:
+            docs = state.tables.get(self.name, {})
+            for doc_id, data in changes.items():
+                if doc_id in docs:
+                    self.backend.write('update', self.name, doc_id, dict(data))
+
+    def remove(self, doc_id):
+        self.backend.write('remove', self.name, doc_id)
+
+    def truncate(self):
+        self.backend.write('truncate', self.name)
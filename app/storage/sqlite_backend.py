@@ -0,0 +1,177 @@
+import sqlite3
+import contextlib
+
+from tinydb.table import Document
+
+from app.lib import serializer
+
+from . import Backend, Table
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _path(field):
+    return '$."' + field.replace('"', '\\"') + '"'
+
+
+class SQLiteTable(Table):
+    """One SQL table per model table, storing each document as a JSON row.
+
+    Equality filters are pushed down into SQL with ``json_extract``, which
+    will use any expression index declared for the field.  Anything else
+    (custom TinyDB query conditions) is evaluated in Python on the rows
+    that the SQL part of the query returned.
+    """
+
+    def __init__(self, backend, name, indexes=()):
+        self.backend = backend
+        self.name = name
+        self.sql_name = _quote(name)
+        self._create(indexes)
+
+    def _create(self, indexes):
+        conn = self.backend.conn
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {self.sql_name} (doc_id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL)')
+        for field in indexes:
+            idx_name = _quote(f'ix_{self.name}_{field}')
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {idx_name} ON {self.sql_name} (json_extract(data, '{_path(field)}'))")
+
+    def _documents(self, rows):
+        return [Document(serializer.loads(data), doc_id=doc_id) for doc_id, data in rows]
+
+    def get(self, doc_id):
+        res = self._documents(self.backend.conn.execute(f'SELECT doc_id, data FROM {self.sql_name} WHERE doc_id = ?', (doc_id,)))
+        if res:
+            return res[0]
+        return None
+
+    def get_many(self, doc_ids):
+        doc_ids = list(doc_ids)
+        res = []
+        # Stay under SQLite's limit on the number of bound parameters
+        for i in range(0, len(doc_ids), 500):
+            chunk = doc_ids[i:i + 500]
+            sql = f'SELECT doc_id, data FROM {self.sql_name} WHERE doc_id IN ({", ".join("?" * len(chunk))})'
+            res.extend(self._documents(self.backend.conn.execute(sql, chunk)))
+        return res
+
+    def all(self):
+        return self._documents(self.backend.conn.execute(f'SELECT doc_id, data FROM {self.sql_name} ORDER BY doc_id'))
+
+    def search(self, filters=None, cond=None, limit=None):
+        where = []
+        params = []
+        for k, v in (filters or {}).items():
+            if isinstance(v, (list, dict)):
+                # Compare structured values in Python, the JSON text may not match exactly
+                cond = self._and(cond, k, v)
+                continue
+            if v is None:
+                # Like TinyDB, match a stored null but not a missing key
+                where.append(f"json_type(data, '{_path(k)}') = 'null'")
+                continue
+            where.append(f"json_extract(data, '{_path(k)}') = ?")
+            params.append(v)
+
+        sql = f'SELECT doc_id, data FROM {self.sql_name}'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY doc_id'
+        if cond is None and limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        res = self._documents(self.backend.conn.execute(sql, params))
+        if cond is not None:
+            res = [doc for doc in res if cond(doc)][:limit]
+        return res
+
+    @staticmethod
+    def _and(cond, key, value):
+        def _cond(doc):
+            return doc.get(key) == value and (cond is None or cond(doc))
+        return _cond
+
+    def insert(self, data, doc_id=None):
+        with self.backend.transaction() as conn:
+            if doc_id is None:
+                cur = conn.execute(f'INSERT INTO {self.sql_name} (data) VALUES (?)', (serializer.dumps(data),))
+            else:
+                cur = conn.execute(f'INSERT INTO {self.sql_name} (doc_id, data) VALUES (?, ?)', (doc_id, serializer.dumps(data)))
+            return cur.lastrowid
+
+    def update(self, data, doc_id):
+        with self.backend.transaction() as conn:
+            row = conn.execute(f'SELECT data FROM {self.sql_name} WHERE doc_id = ?', (doc_id,)).fetchone()
+            if row is None:
+                return
+            doc = serializer.loads(row[0])
+            doc.update(data)
+            conn.execute(f'UPDATE {self.sql_name} SET data = ? WHERE doc_id = ?', (serializer.dumps(doc), doc_id))
+
+    def update_many(self, changes):
+        with self.backend.transaction() as conn:
+            docs = {doc.doc_id: doc for doc in self.get_many(list(changes))}
+            conn.executemany(
+                f'UPDATE {self.sql_name} SET data = ? WHERE doc_id = ?',
+                [(serializer.dumps(dict(docs[doc_id], **data)), doc_id) for doc_id, data in changes.items() if doc_id in docs],
+            )
+
+    def remove(self, doc_id):
+        with self.backend.transaction() as conn:
+            conn.execute(f'DELETE FROM {self.sql_name} WHERE doc_id = ?', (doc_id,))
+
+    def truncate(self):
+        with self.backend.transaction() as conn:
+            conn.execute(f'DELETE FROM {self.sql_name}')
+
+
+class SQLiteBackend(Backend):
+    def __init__(self, filename):
+        self.filename = filename
+        # Transactions are managed explicitly, see transaction()
+        self.conn = sqlite3.connect(filename, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self._tables = {}
+        self._depth = 0
+
+    def table(self, name, indexes=()):
+        if name not in self._tables:
+            self._tables[name] = SQLiteTable(self, name, indexes=indexes)
+        return self._tables[name]
+
+    def tables(self):
+        res = self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")
+        return [r[0] for r in res]
+
+    @contextlib.contextmanager
+    def transaction(self):
+        if self._depth:
+            self._depth += 1
+            try:
+                yield self.conn
+            finally:
+                self._depth -= 1
+            return
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        self._depth = 1
+        try:
+            yield self.conn
+        except:
+            self._depth = 0
+            self.conn.execute('ROLLBACK')
+            raise
+        else:
+            self._depth = 0
+            self.conn.execute('COMMIT')
+
+    def compact(self):
+        self.conn.execute('VACUUM')
+        # VACUUM goes through the WAL like any other write, fold it back into the database
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,360 @@
+import os
+import bisect
+import fcntl
+import itertools
+import struct
+import tempfile
+import threading
+import contextlib
+
+from tinydb import TinyDB
+from tinydb.storages import Storage
+from tinydb.middlewares import Middleware
+from tinydb.table import Document
+
+from app.lib import serializer
+
+from . import Backend, Table, build_query
+
+
+_MISSING = object()
+
+
+class SerializerStorage(Storage):
+    """The database file, read and written with ``app.lib.serializer``.
+
+    Unlike TinyDB's ``JSONStorage`` the file is replaced rather than
+    rewritten in place, so a crash part way through a write leaves the
+    previous version behind instead of a truncated file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        try:
+            with open(self.path, 'rb') as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            return None
+        if not data.strip():
+            return None
+        return serializer.loads(data)
+
+    def write(self, data):
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(self.path) + '-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(serializer.dumps_bytes(data))
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self.path)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        dir_fd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class _LockState:
+    """Per-process lock and cache for one database file, shared by threads."""
+
+    def __init__(self, name):
+        self.name = name
+        self.pid = os.getpid()
+        self.rlock = threading.RLock()
+        self.fd = os.open(name + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        self.depth = 0
+        self.cache = None
+        # Set when the cached data has been written to but not stored yet
+        self.dirty = False
+        # Set once the transaction in progress has its own copy of the data
+        self.private = False
+        # Bumped whenever the data is read from disk again, which makes the
+        # indexes stale; writes made here update them as they go
+        self.version = 0
+        self.indexes = {}
+
+
+class FileLockMiddleware(Middleware):
+    """Serializes access to the database file between processes.
+
+    An exclusive ``flock`` on ``<db>.lock`` is held for every write, and for
+    reads that have to go to disk.  The lock file also holds a generation
+    counter, bumped on every write, which lets each process keep the parsed
+    database in memory and only re-read the file after another process has
+    changed it.
+
+    Writes only change the in-memory copy until the outermost ``locked()``
+    exits, so any number of writes in a transaction cost one rewrite of the
+    file, and a transaction that fails is rolled back by dropping the copy.
+    """
+    states = {}
+    states_lock = threading.Lock()
+
+    def __init__(self, name, storage_cls):
+        # Initialize the parent constructor
+        super().__init__(storage_cls)
+        self.name = name
+
+    @property
+    def state(self):
+        with self.states_lock:
+            state = self.states.get(self.name)
+            # A forked child shares the parent's open lock file, which would
+            # also share the flock - it needs its own
+            if state is None or state.pid != os.getpid():
+                state = self.states[self.name] = _LockState(self.name)
+            return state
+
+    def _get_generation(self, state):
+        data = os.pread(state.fd, 8, 0)
+        if len(data) < 8:
+            return 0
+        return struct.unpack('<Q', data)[0]
+
+    @contextlib.contextmanager
+    def locked(self):
+        state = self.state
+        with state.rlock:
+            if not state.depth:
+                fcntl.flock(state.fd, fcntl.LOCK_EX)
+            state.depth += 1
+            try:
+                yield state
+                if state.depth == 1 and state.dirty:
+                    self._flush(state)
+            except:
+                if state.depth == 1 and (state.dirty or state.private):
+                    # TinyDB changes the cached data in place, re-read it next time
+                    state.dirty = False
+                    state.cache = None
+                raise
+            finally:
+                state.depth -= 1
+                if not state.depth:
+                    state.private = False
+                    fcntl.flock(state.fd, fcntl.LOCK_UN)
+
+    def _flush(self, state):
+        generation = self._get_generation(state) + 1
+        state.dirty = False
+        try:
+            self.storage.write(state.cache[1])
+        except:
+            state.cache = None
+            raise
+        os.pwrite(state.fd, struct.pack('<Q', generation), 0)
+        state.cache = (generation, state.cache[1])
+
+    def read(self):
+        state = self.state
+        with state.rlock:
+            in_transaction = state.depth > 0
+            cache = state.cache
+            if cache is None or cache[0] != self._get_generation(state):
+                with self.locked():
+                    cache = state.cache = (self._get_generation(state), self.storage.read())
+                    state.version += 1
+                # Nobody else has seen it yet
+                state.private = in_transaction
+            elif in_transaction and not state.private and cache[1] is not None:
+                # TinyDB changes what it reads in place before writing it
+                # back, and other threads may still be going through what
+                # they read before the transaction started
+                cache = state.cache = (cache[0], _copy_tables(cache[1]))
+                state.private = True
+            return cache[1]
+
+    def write(self, data):
+        # Stored when the outermost lock is released, which may be this one
+        with self.locked() as state:
+            state.cache = (self._get_generation(state), data)
+            state.dirty = True
+
+
+def _copy_tables(data):
+    return {name: {doc_id: dict(doc) for doc_id, doc in table.items()} for name, table in data.items()}
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+class _FieldIndex:
+    """doc_ids by value of one field, each list in doc_id order (which is
+    the order the documents were inserted in), kept up to date as
+    documents are written"""
+
+    def __init__(self, field, docs):
+        self.field = field
+        self.doc_ids = {}
+        # The value each doc_id is listed under, to find it again
+        self.values = {}
+        for doc_id, doc in docs:
+            self.add(doc_id, doc)
+
+    def get(self, value):
+        return self.doc_ids.get(value, ())
+
+    def add(self, doc_id, doc):
+        value = doc.get(self.field, _MISSING)
+        if value is _MISSING or not _hashable(value):
+            return
+        doc_ids = self.doc_ids.setdefault(value, [])
+        if doc_ids and doc_ids[-1] > doc_id:
+            bisect.insort(doc_ids, doc_id)
+        else:
+            doc_ids.append(doc_id)
+        self.values[doc_id] = value
+
+    def remove(self, doc_id):
+        value = self.values.pop(doc_id, _MISSING)
+        if value is _MISSING:
+            return
+        doc_ids = self.doc_ids[value]
+        del doc_ids[bisect.bisect_left(doc_ids, doc_id)]
+        if not doc_ids:
+            del self.doc_ids[value]
+
+
+class TinyDBTable(Table):
+    def __init__(self, backend, table, indexes=()):
+        self.backend = backend
+        self.table = table
+        self.indexes = tuple(indexes)
+
+    def _indexes(self, state):
+        """This table's indexes built so far, dropped when the data is read from disk again"""
+        entry = state.indexes.get(self.table.name)
+        if entry is None or entry[0] != state.version:
+            entry = state.indexes[self.table.name] = (state.version, {})
+        return entry[1]
+
+    def _index(self, state, table, field):
+        indexes = self._indexes(state)
+        if field not in indexes:
+            indexes[field] = _FieldIndex(field, ((int(doc_id), doc) for doc_id, doc in table.items()))
+        return indexes[field]
+
+    def _reindex(self, doc_ids):
+        """Update the indexes for documents just written, in the transaction that wrote them"""
+        state = self.backend.db.storage.state
+        indexes = self._indexes(state)
+        if not indexes:
+            return
+        table = self.table._read_table()
+        for doc_id in doc_ids:
+            doc = table.get(str(doc_id))
+            for index in indexes.values():
+                index.remove(doc_id)
+                if doc is not None:
+                    index.add(doc_id, doc)
+
+    def _search_indexed(self, fields, filters, cond, limit):
+        state = self.backend.db.storage.state
+        with state.rlock:
+            # Reading first brings the cache, and so the version, up to date
+            table = self.table._read_table()
+            doc_ids = min((self._index(state, table, f).get(filters[f]) for f in fields), key=len)
+            # The other filters are cheap to check on what's left
+            query = build_query(filters, cond)
+            docs = (Document(table[str(doc_id)], doc_id=doc_id) for doc_id in doc_ids)
+            return list(itertools.islice((doc for doc in docs if query(doc)), limit))
+
+    def get(self, doc_id):
+        return self.table.get(doc_id=doc_id)
+
+    def get_many(self, doc_ids):
+        # Table.get(doc_ids=...) scans the whole table, look up each ID instead
+        table = self.table._read_table()
+        res = []
+        for doc_id in doc_ids:
+            raw_doc = table.get(str(doc_id))
+            if raw_doc is not None:
+                res.append(Document(raw_doc, doc_id=doc_id))
+        return res
+
+    def all(self):
+        return self.table.all()
+
+    def search(self, filters=None, cond=None, limit=None):
+        fields = [k for k in self.indexes if k in (filters or {}) and _hashable(filters[k])]
+        if fields:
+            return self._search_indexed(fields, filters, cond, limit)
+        query = build_query(filters, cond)
+        if query is None:
+            return self.table.all()[:limit]
+        return self.table.search(query)[:limit]
+
+    def insert(self, data, doc_id=None):
+        with self.backend.transaction():
+            if doc_id is not None:
+                data = Document(data, doc_id=doc_id)
+            else:
+                # TinyDB remembers the next ID, which is stale if another process has inserted since
+                self.table._next_id = None
+            doc_id = self.table.insert(data)
+            self._reindex([doc_id])
+            return doc_id
+
+    def update(self, data, doc_id):
+        with self.backend.transaction():
+            self.table.update(data, doc_ids=[doc_id])
+            self._reindex([doc_id])
+
+    def update_many(self, changes):
+        with self.backend.transaction():
+            existing = self.table._read_table()
+            doc_ids = [doc_id for doc_id in changes if str(doc_id) in existing]
+            for doc_id in doc_ids:
+                self.table.update(changes[doc_id], doc_ids=[doc_id])
+            self._reindex(doc_ids)
+
+    def remove(self, doc_id):
+        with self.backend.transaction():
+            self.table.remove(doc_ids=[doc_id])
+            self._reindex([doc_id])
+
+    def truncate(self):
+        with self.backend.transaction() as state:
+            self.table.truncate()
+            self._indexes(state).clear()
+
+
+class TinyDBBackend(Backend):
+    def __init__(self, filename):
+        self.db = TinyDB(filename, storage=FileLockMiddleware(filename, SerializerStorage))
+        self._tables = {}
+
+    def table(self, name, indexes=()):
+        if name not in self._tables:
+            # The query cache would go stale when other processes write, and
+            # the middleware already caches the parsed data
+            self._tables[name] = TinyDBTable(self, self.db.table(name, cache_size=0), indexes=indexes)
+        return self._tables[name]
+
+    def transaction(self):
+        return self.db.storage.locked()
+
+    def tables(self):
+        return sorted(self.db.tables())
+
+    def compact(self):
+        # Every write already rewrites the whole file, all that's left is dropping empty tables
+        with self.transaction():
+            data = self.db.storage.read() or {}
+            self.db.storage.write({k: v for k, v in data.items() if v})
+
+    def close(self):
+        self.db.close()
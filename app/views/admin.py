@@ -1,4 +1,6 @@
 import datetime
+import json
+import time
 from collections import namedtuple
 
 from flask import (
@@ -11,17 +13,21 @@ from flask import (
     abort,
     request,
     session,
+    Response,
 )
 
 from app.forms.drinks import DrinkForm, DrinkComponentForm
 from app.forms.config import ConfigForm
-from app.database import Drink, DrinkComponent, Order, SavedOrder, RuntimeConfig, OrderStat, Event, Device
+from app.database import Drink, DrinkComponent, Order, SavedOrder, RuntimeConfig, OrderStat, OrderStatRollup, ComponentStatRollup, Event, Device, Counter, prefetch
 from app.lib.printer import queue_order_to_print, PrintError
 from app.lib.auth import require_login
+from app.lib import archive, notify, order_events
 
 
 app = Blueprint('admin', __name__)
 
+ORDER_STREAM_DURATION = 300
+
 
 @app.route('/', methods=['GET'])
 @require_login(admin=True)
@@ -118,13 +124,17 @@ def delete_drink_component(id):
 def orders():
     orders = Order.find(printed=False)
     printed_orders = Order.find(printed=True)
-    saved_orders = SavedOrder.all()
+    saved_orders = list(SavedOrder.all())
+
+    # Load everything the rows refer to up front, get_drink/get_components then hit the identity map
+    prefetch(orders + printed_orders, 'drink', Drink)
+    prefetch(orders + printed_orders + saved_orders, 'drink_components', DrinkComponent)
 
     def get_drink(id):
         return Drink.get(id)
 
     def get_components(ids):
-        return DrinkComponent.find(*ids)
+        return DrinkComponent.get_many(ids)
 
     return render_template(
         'admin/orders.jinja.html',
@@ -133,11 +143,42 @@ def orders():
         saved_orders=saved_orders,
         get_drink=get_drink,
         get_components=get_components,
-        total_orders_ev=len(list(OrderStat.find(event=Event.get_current_id()))),
-        total_orders_all=len(list(OrderStat.all())),
+        total_orders_ev=OrderStat.count(event=Event.get_current_id()),
+        total_orders_all=OrderStat.count(),
+        generation=Counter.get_value('orders'),
     )
 
 
+@app.route('/orders/stream', methods=['GET'])
+@require_login(admin=True)
+def orders_stream():
+    """Server-sent events for the orders page, see order_events.publish"""
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    # Subscribe before checking the generation, so nothing is missed in between
+    sub = notify.subscribe(order_events.CHANNEL)
+    generation = Counter.get_value('orders')
+
+    def _stream():
+        try:
+            yield 'retry: 2000\n\n'
+            if since != str(generation):
+                yield 'event: reload\ndata: {}\n\n'
+                return
+            # End the stream now and then so it doesn't hold a worker forever
+            deadline = time.time() + ORDER_STREAM_DURATION
+            while time.time() < deadline:
+                msg = sub.wait(timeout=15)
+                if msg is None:
+                    yield ': keepalive\n\n'
+                    continue
+                data = json.loads(msg)
+                yield f"id: {data['generation']}\nevent: {data['event']}\ndata: {msg.decode('utf-8')}\n\n"
+        finally:
+            sub.close()
+
+    return Response(_stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/orders/print/<int:id>', methods=['POST'])
 @require_login(admin=True)
 def print_order(id):
@@ -167,7 +208,9 @@ def complete_order(id):
                 drink.save()
 
         OrderStat.from_order(order)
+        order_id = order.doc_id
         order.delete()
+        order_events.publish(order_events.COMPLETED, order_id)
         flash(f"Completed order {order.drink_name} for {order.name}", 'success')
 
     return redirect(url_for('.orders'))
@@ -180,7 +223,9 @@ def delete_order(id):
     if not order:
         flash("No such order", 'danger')
     else:
+        order_id = order.doc_id
         order.delete()
+        order_events.publish(order_events.DELETED, order_id)
         flash(f"Deleted order {order.drink_name} for {order.name}", 'success')
 
     return redirect(url_for('.orders'))
@@ -217,11 +262,10 @@ def config():
         c.save()
 
         if form.new_event.data:
-            for e in Event.find(is_current=True):
-                e.is_current = False
+            with Event.transaction():
+                Event.bulk_update({e.doc_id: {'is_current': False} for e in Event.find(is_current=True)})
+                e = Event(name=form.new_event.data, date=str(datetime.datetime.utcnow()), is_current=True)
                 e.save()
-            e = Event(name=form.new_event.data, date=str(datetime.datetime.utcnow()), is_current=True)
-            e.save()
             flash(f'Created new event "{e.name}"', 'info')
             # The form must be recreated so that we can reload the current event, and clear out the new event field
             form = ConfigForm(obj=c, house_device=session.get('house_device'))
@@ -264,27 +308,41 @@ def stats():
             drink = Drink.get(stat.drink)
             if drink:
                 dest['drinks'].setdefault(drink.name, 0)
-                dest['drinks'][drink.name] += 1
+                dest['drinks'][drink.name] += stat.count
 
         dest['strengths'].setdefault(stat.strength, 0)
-        dest['strengths'][stat.strength] += 1
+        dest['strengths'][stat.strength] += stat.count
 
-        dest['count'] += 1
-        dest['total_oz'] += est_oz.get(stat.strength, 2)
+        dest['count'] += stat.count
+        dest['total_oz'] += est_oz.get(stat.strength, 2) * stat.count
 
-    for stat in OrderStat.all():
+    # One row per (event, drink, strength), rather than one per order ever served
+    rollup = list(OrderStatRollup.all())
+    prefetch(rollup, 'drink', Drink)
+    for stat in rollup:
         if (selected_event == 0 and not stat.event) or stat.event == selected_event or (selected_event == -1 and stat.event not in valid_events):
             add_stat(stats_ev, stat)
         add_stat(stats_all, stat)
 
+    if selected_event > 0:
+        stats_ev['components'] = {}
+        component_stats = ComponentStatRollup.find(event=selected_event)
+        prefetch(component_stats, 'component', DrinkComponent)
+        for stat in component_stats:
+            component = DrinkComponent.get(stat.component)
+            if component:
+                stats_ev['components'][component.name] = stats_ev['components'].get(component.name, 0) + stat.count
+
     for dest in (stats_ev, stats_all):
         dest['drinks'] = sorted(dest['drinks'].items(), key=lambda v: v[1], reverse=True)
         dest['strengths'] = sorted(dest['strengths'].items(), key=lambda v: v[1], reverse=True)
-
+        if 'components' in dest:
+            dest['components'] = sorted(dest['components'].items(), key=lambda v: v[1], reverse=True)
 
     return render_template(
         'admin/stats.jinja.html',
         events=events,
+        archived_events=archive.archived_events(),
         selected_event=selected_event,
         stats_ev=stats_ev,
         stats_all=stats_all,
@@ -297,16 +355,18 @@ def stats():
 @require_login(admin=True)
 def devices():
     if request.method == 'POST':
-        updated = 0
-        for dev in Device.all():
-            if dev.device_id in request.form.getlist('delete'):
-                dev.delete()
-                flash(f"Deleted device {dev.device_id}", 'info')
-            else:
-                dev.is_house_device = dev.device_id in request.form.getlist('is_house_device')
-                dev.use_osk = dev.device_id in request.form.getlist('use_osk')
-                dev.save()
-                updated += 1
+        updated = {}
+        with Device.transaction():
+            for dev in Device.all():
+                if dev.device_id in request.form.getlist('delete'):
+                    dev.delete()
+                    flash(f"Deleted device {dev.device_id}", 'info')
+                else:
+                    updated[dev.doc_id] = {
+                        'is_house_device': dev.device_id in request.form.getlist('is_house_device'),
+                        'use_osk': dev.device_id in request.form.getlist('use_osk'),
+                    }
+            Device.bulk_update(updated)
         if updated:
-            flash(f"Updated {updated} devices", 'success')
+            flash(f"Updated {len(updated)} devices", 'success')
     return render_template('admin/devices.jinja.html', devices=Device.all())
\ No newline at end of file
@@ -10,11 +10,22 @@ from flask import (
     abort,
     jsonify,
     request,
+    current_app,
 )
 
-from app.lib.printer import get_queued_order, clear_queued_order, get_order_printable, PrintError
+from app.lib.printer import (
+    claim_print_job,
+    claim_print_jobs,
+    complete_print_job,
+    finish_print_jobs,
+    get_order_printable,
+    get_order_printables,
+    get_print_assets,
+    PrintError,
+)
 from app.lib.auth import require_login
-from app.database import Order, Drink, DrinkComponent
+from app.lib import notify
+from app.database import Drink, DrinkComponent, PrintJob
 
 
 logger = logging.getLogger(__name__)
@@ -43,6 +54,10 @@ def index():
     abort(404)
 
 
+def get_worker():
+    return request.values.get('worker') or request.remote_addr
+
+
 @app.route('/print/job', methods=['GET', 'POST'])
 @app.route('/print/job/<int:id>', methods=['GET', 'POST'])
 @json_response
@@ -50,9 +65,10 @@ def print_job(id=None):
     if request.method == 'POST':
         if not id:
             abort(400, "An ID is required to clear")
-        doc_id = clear_queued_order(order_id=id)
-        if not doc_id:
-            abort(400, "The ID is invalid")
+        try:
+            complete_print_job(id, worker=request.values.get('worker'))
+        except PrintError as e:
+            abort(400, str(e))
 
         return "OK"
 
@@ -61,13 +77,85 @@ def print_job(id=None):
 
     else:
         to = int(request.args.get('timeout') or 10)
-        t = time.time()
-        while time.time() - t < to:
-            res = get_queued_order()
+        printer = request.args.get('printer')
+        deadline = time.time() + to
+        # Subscribe before checking the queue so that a job queued in between isn't missed
+        with notify.subscribe('print') as sub:
+            while True:
+                try:
+                    res = claim_print_job(get_worker(), printer=printer)
+                except PrintError as e:
+                    abort(400, str(e))
+                if res:
+                    job, order = res
+                    return get_order_printable(order, job=job)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                sub.wait(remaining)
+
+
+@app.route('/print/jobs', methods=['GET', 'POST'])
+@json_response
+def print_jobs():
+    """Claim several jobs at once, or report how several jobs went.
+
+    GET waits for jobs like /print/job, then claims up to ``max`` of them.
+    POST takes a list of ``{"id": job_id, "result": "printed" or
+    "failed"}``, completing the printed jobs and putting the failed ones
+    back, and returns the IDs of any jobs the worker no longer held.
+    """
+    if request.method == 'POST':
+        try:
+            results = {int(r['id']): r['result'] for r in request.json}
+        except (TypeError, KeyError, ValueError):
+            abort(400, 'Expected a list of {"id": ..., "result": ...}')
+        try:
+            return finish_print_jobs(results, worker=request.values.get('worker'))
+        except PrintError as e:
+            abort(400, str(e))
+
+    to = int(request.args.get('timeout') or 10)
+    max_jobs = max(1, min(int(request.args.get('max') or 1), current_app.config.get('PRINT_JOBS_MAX_BATCH', 50)))
+    printer = request.args.get('printer')
+    deadline = time.time() + to
+    with notify.subscribe('print') as sub:
+        while True:
+            try:
+                res = claim_print_jobs(get_worker(), printer=printer, max_jobs=max_jobs)
+            except PrintError as e:
+                abort(400, str(e))
             if res:
-                return get_order_printable(res)
-            time.sleep(1)
-        return None
+                return get_order_printables(res)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return []
+            sub.wait(remaining)
+
+
+@app.route('/print/assets', methods=['GET'])
+@json_response
+def print_assets():
+    """URLs that print workers should have cached before printing"""
+    return get_print_assets()
+
+
+@app.route('/print/job/<int:id>/heartbeat', methods=['POST'])
+@json_response
+def print_job_heartbeat(id):
+    if not PrintJob.heartbeat(id, worker=request.values.get('worker'), lease=current_app.config.get('PRINT_JOB_LEASE', 30)):
+        abort(409, "The job is not held by this worker")
+    return "OK"
+
+
+@app.route('/print/job/<int:id>/release', methods=['POST'])
+@json_response
+def print_job_release(id):
+    if not PrintJob.release(id, worker=request.values.get('worker')):
+        abort(409, "The job is not held by this worker")
+    # Someone else may be able to print it
+    notify.publish('print')
+    return "OK"
 
 
 @app.route('/admin/reorder/<type_>', methods=['POST'])
@@ -1,5 +1,6 @@
 import os
 
+import werkzeug.utils
 from flask import (
     Blueprint,
     render_template,
@@ -8,22 +9,23 @@ from flask import (
     flash,
     redirect,
     url_for,
-    send_file,
     current_app,
     session,
+    make_response,
 )
+from markupsafe import Markup
 
-import PIL
-from PIL import Image
-
-from app.database import Drink, DrinkComponent, Order, SavedOrder, Event, Device
+from app.database import Drink, DrinkComponent, Order, SavedOrder, Event, Device, prefetch
 from app.forms.orders import OrderForm
-from app.lib.auth import require_login, is_house_device
-from app.lib.printer import queue_order_to_print, PrintError
+from app.lib import cache, order_events, images as images_lib
+from app.lib.auth import require_login, is_house_device, use_osk
+from app.lib.printer import build_order_printable, queue_order_to_print, PrintError
 
 
 app = Blueprint('index', __name__)
 
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
 
 @app.route('/init-device/<device_id>', methods=['GET'])
 def init_device(device_id):
@@ -35,8 +37,7 @@ def init_device(device_id):
     return redirect(url_for('.index'))
 
 
-@app.route('/', methods=['GET'])
-def index():
+def _render_menu():
     # drinks = Drink.find(is_orderable=True, in_stock=True, sort_key='order')
     saved_orders = SavedOrder.all()
     # drink_components = DrinkComponent.find(in_stock=True, sort_key='order')
@@ -50,11 +51,33 @@ def index():
         have_coms = o_coms & in_stock_drink_components
         return have_coms == o_coms
     saved_orders = list(filter(_filter_saved, saved_orders))
+    prefetch(saved_orders, 'drink_components', DrinkComponent)
 
     def get_components(ids):
         return DrinkComponent.find(*ids, sort_key='order')
 
-    return render_template('index/index.jinja.html', drinks=drinks, saved_orders=saved_orders, drink_components=drink_components, get_components=get_components)
+    return Markup(render_template('index/menu.jinja.html', drinks=drinks, saved_orders=saved_orders, drink_components=drink_components, get_components=get_components))
+
+
+@app.route('/', methods=['GET'])
+def index():
+    # The menu only changes when a Drink, DrinkComponent or SavedOrder is
+    # written, the rest of the page only with the device's settings
+    generation = cache.generation('menu')
+    etag = None
+    if not session.get('_flashes'):
+        etag = f'menu-{generation}-{int(bool(use_osk()))}'
+        if etag in request.if_none_match:
+            res = current_app.response_class(status=304)
+            res.set_etag(etag)
+            return res
+
+    menu = cache.rendered.get(('menu', request.script_root), generation, _render_menu)
+    res = make_response(render_template('index/index.jinja.html', menu=menu))
+    if etag:
+        res.set_etag(etag)
+        res.cache_control.no_cache = True
+    return res
 
 
 @app.route('/order', methods=['GET', 'POST'])
@@ -106,7 +129,9 @@ def order():
         if not drink and hasattr(form, 'save_for_later') and form.save_for_later.data:
             SavedOrder(drink_name=params['drink_name'], drink_components=params['drink_components']).save()
         order = Order(event=Event.get_current_id(), **params)
+        order.set_printable(build_order_printable(order))
         order.save()
+        order_events.publish(order_events.CREATED, order.doc_id, order)
         try:
             queue_order_to_print(order=order, auto=True)
         except PrintError:
@@ -119,26 +144,53 @@ def order():
     return render_template('index/order.jinja.html', form=form, drink=drink, drink_components=drink_components)
 
 
+def _send_image(filename, immutable=False):
+    mode = current_app.config.get('IMAGES_SENDFILE')
+    # Versioned URLs never change, anything else is revalidated on every use
+    max_age = IMMUTABLE_MAX_AGE if immutable else None
+    res = werkzeug.utils.send_file(
+        filename,
+        request.environ,
+        max_age=max_age,
+        use_x_sendfile=bool(mode),
+        response_class=current_app.response_class,
+    )
+    if mode == 'x-accel-redirect' and 'X-Sendfile' in res.headers:
+        relpath = os.path.relpath(res.headers.pop('X-Sendfile'), os.path.join(current_app.config['DATA_DIRECTORY'], 'images'))
+        res.headers['X-Accel-Redirect'] = current_app.config.get('IMAGES_SENDFILE_PREFIX', '/_images/').rstrip('/') + '/' + relpath
+    if immutable:
+        res.cache_control.immutable = True
+    return res
+
+
 @app.route('/images/<name>', methods=['GET'])
-@app.route('/images/<any(full):mode>/<name>', methods=['GET'])
+@app.route('/images/<mode>/<name>', methods=['GET'])
 def images(name, mode=None):
-    outfile = None
-    orig = os.path.abspath(os.path.join(current_app.config['DATA_DIRECTORY'], 'images', name))
+    data_dir = current_app.config['DATA_DIRECTORY']
+    orig = images_lib.image_path(data_dir, name)
+    if os.path.basename(name) != name or not os.path.exists(orig):
+        abort(404)
+
+    mode = mode or images_lib.DEFAULT_DERIVATIVE
+    versioned = request.args.get('v') == images_lib.image_version(name, mode)
     if mode == 'full':
-        outfile = orig
+        return _send_image(orig, immutable=versioned)
+    if mode not in images_lib.get_derivatives():
+        abort(404)
+
+    # Only browsers that ask for WebP get it, */* is what the print worker sends
+    accepted = [m for m, q in request.accept_mimetypes if q]
+    for ext, _ in images_lib.get_formats():
+        if ext == 'webp' and 'image/webp' not in accepted:
+            continue
+        outfile = images_lib.derivative_path(data_dir, name, mode, ext)
+        if os.path.exists(outfile):
+            res = _send_image(outfile, immutable=versioned)
+            break
     else:
-        cached = os.path.abspath(os.path.join(current_app.config['DATA_DIRECTORY'], 'images', 'resized', name))
-        if not os.path.exists(cached):
-            img = Image.open(orig)
-            img = img.convert('RGBA')
-            w, h = img.size
-            sz = max(w, h)
-            out = Image.new('RGBA', (sz, sz), (0, 0, 0, 0))
-            out.paste(img, (int((sz - w)), 0))
-            out = out.resize((144, 144), PIL.Image.ANTIALIAS)
-
-            with open(cached, 'wb') as fp:
-                out.save(fp, 'PNG', quality=70)
-        outfile = cached
-
-    return send_file(outfile, mimetype='image/png')
+        # Never resize in the request, generate it in the background and make
+        # do for now - without caching, the derivative will replace this
+        images_lib.schedule_derivatives(name)
+        res = _send_image(orig)
+    res.vary.add('Accept')
+    return res
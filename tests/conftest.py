@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+from app import create_app
+from app.storage import BACKENDS
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """Build an app with a scratch data directory, ``config`` overriding the defaults"""
+    def _make_app(**config):
+        settings = {
+            'SECRET_KEY': 'test',
+            'DATA_DIRECTORY': str(tmp_path / 'data'),
+            'DATABASE_BACKEND': 'json',
+            'SITE_NAME': 'Drink Menu',
+            'WTF_CSRF_ENABLED': False,
+            'API_URL': 'http://localhost/api',
+            'ESCPOS_PRINTER_HAS_CUTTER': True,
+            'ESCPOS_PRINTER_FMT': [{'command': 'name'}, {'command': 'cut'}],
+        }
+        settings.update(config)
+        filename = tmp_path / 'config.json'
+        filename.write_text(json.dumps(settings))
+        return create_app(str(filename))
+    return _make_app
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def backend_name(request):
+    return request.param
+
+
+@pytest.fixture
+def app(make_app, backend_name):
+    app = make_app(DATABASE_BACKEND=backend_name)
+    with app.app_context():
+        yield app
@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+pytest.importorskip('requests')
+
+from app.lib.assets import AssetCache
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+    def iter_content(self, chunk_size):
+        yield self.content
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    """Serves one logo, and runs ``on_revalidate`` when asked if it changed"""
+
+    def __init__(self, on_revalidate=None):
+        self.on_revalidate = on_revalidate
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(dict(headers or {}))
+        if headers and headers.get('If-None-Match') == '"v1"':
+            if self.on_revalidate:
+                self.on_revalidate()
+            return FakeResponse(304)
+        return FakeResponse(200, b'logo', {'ETag': '"v1"'})
+
+
+def test_revalidated_logo_is_kept(tmp_path):
+    cache = AssetCache(str(tmp_path))
+    cache.session = FakeSession()
+    url = 'http://localhost/logo.png'
+    filename = cache.fetch(url)
+    checked = cache.index[url]['checked']
+
+    assert cache.fetch(url) == filename
+    assert cache.session.requests[-1] == {'If-None-Match': '"v1"'}
+    assert cache.index[url]['checked'] >= checked
+
+
+def test_logo_evicted_while_revalidating(tmp_path):
+    """A 304 for an entry evicted in the meantime downloads the logo again"""
+    cache = AssetCache(str(tmp_path))
+    url = 'http://localhost/logo.png'
+
+    def evict():
+        with cache.lock:
+            cache.index.pop(url)
+            cache._evict()
+
+    cache.session = FakeSession()
+    cache.fetch(url)
+    cache.session = FakeSession(on_revalidate=evict)
+    filename = cache.fetch(url)
+
+    assert len(cache.session.requests) == 2
+    assert url in cache.index
+    with open(filename, 'rb') as fp:
+        assert fp.read() == b'logo'
+    assert os.path.basename(filename) == cache.index[url]['hash']
@@ -0,0 +1,29 @@
+from app.database import Drink, PrintJob
+
+
+def test_bulk_update_leaves_other_fields_alone(app):
+    drink = Drink(name='Margarita', in_stock=False, is_orderable=False, has_mocktail=True, inventory_level=3)
+    drink.save()
+    job = PrintJob(order=1, state=PrintJob.CLAIMED, claimed_by='w1', lease_expires=100, attempts=2)
+    job.save()
+
+    Drink.bulk_update({drink.doc_id: {'order': 5}})
+    PrintJob.bulk_update({job.doc_id: {'printer': 'bar'}})
+
+    drink = Drink.get(drink.doc_id)
+    assert drink.order == 5
+    assert (drink.in_stock, drink.is_orderable, drink.has_mocktail, drink.inventory_level) == (False, False, True, 3)
+    job = PrintJob.get(job.doc_id)
+    assert job.printer == 'bar'
+    assert (job.state, job.claimed_by, job.lease_expires, job.attempts) == (PrintJob.CLAIMED, 'w1', 100, 2)
+
+
+def test_reorder_only_changes_order(app):
+    drink = Drink(name='Margarita', in_stock=False, inventory_level=3)
+    drink.save()
+
+    res = app.test_client().post('/api/admin/reorder/drinks', json={str(drink.doc_id): 5})
+    assert res.status_code == 200
+
+    drink = Drink.get(drink.doc_id)
+    assert (drink.order, drink.in_stock, drink.inventory_level) == (5, False, 3)
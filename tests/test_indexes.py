@@ -0,0 +1,77 @@
+import pytest
+
+from app import database
+from app.storage import tinydb_backend
+
+
+def _indexed_models():
+    return sorted((
+        v for v in vars(database).values()
+        if isinstance(v, type) and issubclass(v, database.Model) and v.__indexes__
+    ), key=lambda m: m.__name__)
+
+
+def _populate():
+    event = database.Event(name='Party', is_current=True)
+    event.save()
+    database.Event(name='Old party').save()
+    for i, name in enumerate(['Margarita', 'Mojito', 'Negroni']):
+        database.Drink(name=name, in_stock=bool(i % 2), is_orderable=i != 2).save()
+        database.DrinkComponent(name=name + ' mix', in_stock=bool(i % 2)).save()
+    for i in range(6):
+        order = database.Order(event=event.doc_id, name=f'Guest {i}', drink=i % 3 + 1, printed=bool(i % 2))
+        order.save()
+        database.PrintJob.enqueue(order.doc_id, printer='bar' if i % 3 else None)
+        database.OrderStat.from_order(order)
+    database.Device(device_id='kiosk', is_house_device=True).save()
+    database.Device(device_id='phone').save()
+
+
+def _check_indexed_searches():
+    for model in _indexed_models():
+        table = model._get_table()
+        docs = table.all()
+        for field in model.__indexes__:
+            values = [d[field] for d in docs if field in d]
+            # Look for something that isn't there too
+            for value in values + ['\0 no such value']:
+                expected = [d.doc_id for d in docs if field in d and d[field] == value]
+                found = [d.doc_id for d in table.search({field: value})]
+                assert found == expected, f"{model.__name__}.{field} == {value!r}"
+
+
+def test_indexed_searches_match_a_full_scan(app):
+    """Searches on __indexes__ fields find the same documents as a full scan"""
+    _populate()
+    _check_indexed_searches()
+
+    # Indexes have to keep up with inserts, updates and deletes too
+    job = database.PrintJob.claim('w1', printer='bar')
+    database.PrintJob.release(job.doc_id, 'w1')
+    database.PrintJob.claim('w1')
+    database.Order.get(2).delete()
+    database.Order.bulk_update({1: {'printed': True}, 3: {'printed': False}})
+    order = database.Order(event=1, name='Late guest', drink=1)
+    order.save()
+    database.PrintJob.enqueue(order.doc_id)
+    _check_indexed_searches()
+
+
+def test_writes_dont_rebuild_indexes(app, monkeypatch):
+    """Indexes are updated by each write rather than built again"""
+    if app.config['DATABASE_BACKEND'] == 'sqlite':
+        pytest.skip("SQLite keeps its own indexes")
+    _populate()
+    _check_indexed_searches()
+
+    built = []
+    init = tinydb_backend._FieldIndex.__init__
+    monkeypatch.setattr(tinydb_backend._FieldIndex, '__init__', lambda self, *args: built.append(args[0]) or init(self, *args))
+    for i in range(3):
+        order = database.Order(event=1, name=f'Guest {i}', drink=1)
+        order.save()
+        database.PrintJob.enqueue(order.doc_id)
+        database.PrintJob.claim('w1')
+        database.Order.find(printed=False)
+    _check_indexed_searches()
+    assert built == []
@@ -0,0 +1,120 @@
+import multiprocessing
+import os
+import random
+import signal
+
+import pytest
+
+from app.storage import StorageError
+from app.storage.log_backend import LogBackend, _encode
+
+
+# Where the writer is killed: before or after each step of a transaction or checkpoint
+CRASH_POINTS = {
+    'append': ('_commit', 'before'),
+    'appended': ('_sync', 'before'),
+    'synced': ('_sync', 'after'),
+    'snapshot': ('_write_checkpoint', 'before'),
+    'snapshot-renamed': ('_new_log', 'before'),
+    'log-renamed': ('_new_log', 'after'),
+}
+
+
+def _kill_at(monkeypatch, crash_at, crash_after):
+    method, when = CRASH_POINTS[crash_at]
+    original = getattr(LogBackend, method)
+    hits = [0]
+
+    def _hit():
+        hits[0] += 1
+        if hits[0] >= crash_after:
+            os.kill(os.getpid(), signal.SIGKILL)
+
+    def wrapper(self, *args, **kwargs):
+        if when == 'before':
+            _hit()
+        res = original(self, *args, **kwargs)
+        _hit()
+        return res
+
+    monkeypatch.setattr(LogBackend, method, wrapper)
+
+
+def _crash_worker(filename, crash_at, crash_after, acked):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        _kill_at(monkeypatch, crash_at, crash_after)
+        # A small log, so checkpoints happen often
+        backend = LogBackend(filename, checkpoint_bytes=4096)
+        counter = backend.table('CrashCounter')
+        rows = backend.table('CrashRow')
+        while True:
+            with backend.transaction():
+                value = counter.get(1)['value'] + 1
+                counter.update({'value': value}, 1)
+                rows.insert({'i': value, 'padding': 'x' * random.randint(0, 200)})
+                # Keep the table from growing forever, so checkpoints stay quick
+                if value > 50:
+                    stale = rows.search({'i': value - 50})
+                    if stale:
+                        rows.remove(stale[0].doc_id)
+            acked.value = value
+
+
+def _reopen(filename):
+    # Read it as a process that has just started would
+    LogBackend.states.pop(filename, None)
+    return LogBackend(filename)
+
+
+def test_recovers_from_crashes(tmp_path):
+    """Kill a writer at random steps of a transaction or checkpoint, and
+    sometimes leave the log ending in part of a record as a write torn by
+    a power cut would.  The database must come back with every
+    acknowledged transaction, and no half of any other."""
+    rand = random.Random(1)
+    ctx = multiprocessing.get_context('fork')
+    filename = str(tmp_path / 'db.log')
+    LogBackend(filename).table('CrashCounter').insert({'value': 0})
+    acked = ctx.Value('q', 0)
+
+    for i in range(100):
+        crash_at = rand.choice(sorted(CRASH_POINTS))
+        # Checkpoints are much rarer than transactions
+        crash_after = rand.randint(1, 3 if CRASH_POINTS[crash_at][0] in ('_write_checkpoint', '_new_log') else 30)
+        proc = ctx.Process(target=_crash_worker, args=(filename, crash_at, crash_after, acked))
+        proc.start()
+        proc.join(60)
+        if proc.is_alive():
+            proc.kill()
+        assert proc.exitcode == -signal.SIGKILL, f"the writer didn't reach {crash_at}"
+
+        if rand.random() < 0.3:
+            record = _encode([['update', 'CrashCounter', 1, {'value': -1}]])
+            with open(filename, 'ab') as fp:
+                fp.write(record[:rand.randint(1, len(record) - 1)])
+
+        backend = _reopen(filename)
+        value = backend.table('CrashCounter').get(1)['value']
+        found = sorted(r['i'] for r in backend.table('CrashRow').all())
+        assert found == list(range(max(value - 49, 1), value + 1)), f"after a crash at {crash_at}"
+        # The last transaction may have made it to disk before it was acknowledged
+        assert acked.value <= value <= acked.value + 1, f"after a crash at {crash_at}"
+        # The recovered state is what the next writer carries on from
+        acked.value = value
+
+
+def test_corruption_inside_the_log_is_an_error(tmp_path):
+    filename = str(tmp_path / 'db.log')
+    table = LogBackend(filename).table('Item')
+    for i in range(3):
+        table.insert({'i': i})
+
+    with open(filename, 'r+b') as fp:
+        lines = fp.read().split(b'\n')
+        # Damage the middle record, not the last one
+        lines[2] = lines[2].replace(b'"i"', b'"j"')
+        fp.seek(0)
+        fp.write(b'\n'.join(lines))
+
+    with pytest.raises(StorageError):
+        _reopen(filename).table('Item').all()
@@ -0,0 +1,139 @@
+import asyncio
+import collections
+import logging
+import random
+
+import pytest
+
+web = pytest.importorskip('aiohttp.web')
+from aiohttp.test_utils import TestServer, unused_port
+
+from app.lib import print_agent
+from app.lib.printer import get_printer_configs
+
+
+class StandInAPI:
+    """Just enough of the print API to run the agent against, with failures"""
+
+    def __init__(self, jobs, error_rate, rand):
+        self.jobs = jobs
+        self.queued = collections.deque(range(1, jobs + 1))
+        self.error_rate = error_rate
+        self.rand = rand
+        self.acked = collections.Counter()
+        self.errors = 0
+        self.requests = 0
+        self.connections = set()
+        self.done = asyncio.Event()
+
+    def _fail(self, request):
+        self.requests += 1
+        self.connections.add(request.transport.get_extra_info('peername'))
+        if self.rand.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    async def get_jobs(self, request):
+        if self._fail(request):
+            return web.json_response({'error': {'code': 500, 'message': "Injected failure"}}, status=500)
+        if not self.queued:
+            await asyncio.sleep(0.05)
+            return web.json_response({'result': []})
+        batch = []
+        while self.queued and len(batch) < int(request.query.get('max', 1)):
+            job_id = self.queued.popleft()
+            batch.append({
+                'id': job_id,
+                'order_id': job_id,
+                'logo': None,
+                'name': f'Guest {job_id}',
+                'drink_name': None,
+                'drink': 'Margarita [strong]',
+                'drink_components': None,
+            })
+        return web.json_response({'result': batch})
+
+    async def finish_jobs(self, request):
+        if self._fail(request):
+            return web.json_response({'error': {'code': 500, 'message': "Injected failure"}}, status=500)
+        for r in await request.json():
+            if r['result'] == 'printed':
+                self.acked[r['id']] += 1
+            else:
+                self.queued.append(r['id'])
+        if len(self.acked) >= self.jobs:
+            self.done.set()
+        return web.json_response({'result': []})
+
+    async def assets(self, request):
+        return web.json_response({'result': []})
+
+    def app(self):
+        app = web.Application()
+        app.add_routes([
+            web.get('/api/print/jobs', self.get_jobs),
+            web.post('/api/print/jobs', self.finish_jobs),
+            web.get('/api/print/assets', self.assets),
+        ])
+        return app
+
+
+def _printer_configs(make_app, printers):
+    app = make_app()
+    with app.app_context():
+        base = get_printer_configs()[0]
+    return [dict(base, name=f'test-{i}', mode='dummy') for i in range(printers)]
+
+
+@pytest.mark.asyncio
+async def test_agent_retries_until_every_job_is_printed_once(make_app, aiohttp_server):
+    """The API fails requests at random, every job is still printed and acked exactly once"""
+    printers, jobs = 3, 200
+    printer_configs = _printer_configs(make_app, printers)
+
+    # The injected failures are expected, keep them out of the log
+    logging.getLogger(print_agent.__name__).setLevel(logging.CRITICAL)
+
+    api = StandInAPI(jobs, 0.2, random.Random(1))
+    server = await aiohttp_server(api.app())
+
+    # The stand-in has no leases to expire, so a job whose ack was given up on would never finish
+    agent = print_agent.AsyncPrintAgent(str(server.make_url('/api')), printer_configs, poll_timeout=1, backoff_base=0.01, backoff_cap=0.2, ack_attempts=50)
+    run = asyncio.create_task(agent.run())
+    try:
+        await asyncio.wait_for(api.done.wait(), 60)
+    finally:
+        agent.stop()
+        await run
+
+    assert api.errors
+    assert sorted(api.acked) == list(range(1, jobs + 1))
+    assert set(api.acked.values()) == {1}
+    assert sum(p.printed for p in agent.printers) == jobs
+    output = b''.join(p.printer.output for p in agent.printers if p.printer)
+    assert [i for i in range(1, jobs + 1) if output.count(f'Guest {i}\n'.encode('ascii')) != 1] == []
+    # Requests reuse the shared session's connections
+    assert len(api.connections) <= printers * 2 + 2
+
+
+def test_agent_built_outside_the_loop(make_app):
+    """The agent is built before asyncio.run() starts its loop, as the print command does"""
+    jobs, port = 20, unused_port()
+    agent = print_agent.AsyncPrintAgent(f'http://127.0.0.1:{port}/api', _printer_configs(make_app, 2), poll_timeout=1)
+
+    async def main():
+        api = StandInAPI(jobs, 0, random.Random(1))
+        server = TestServer(api.app(), port=port)
+        await server.start_server()
+        run = asyncio.create_task(agent.run())
+        try:
+            await asyncio.wait_for(api.done.wait(), 30)
+        finally:
+            agent.stop()
+            await run
+            await server.close()
+        return api
+
+    api = asyncio.run(main())
+    assert sorted(api.acked) == list(range(1, jobs + 1))
@@ -0,0 +1,72 @@
+import multiprocessing
+import random
+import time
+
+from app.database import PrintJob
+
+
+def _claim_worker(app, worker, abandon, results):
+    with app.app_context():
+        printed = []
+        while True:
+            job = PrintJob.claim(worker, lease=0.2)
+            if not job:
+                if not list(PrintJob.all()):
+                    break
+                # Wait for abandoned leases to expire
+                time.sleep(0.05)
+                continue
+            if random.random() < abandon:
+                # Simulate a printer that died holding the job
+                continue
+            if PrintJob.complete(job.doc_id, worker):
+                printed.append(job.order)
+        results.put(printed)
+
+
+def test_concurrent_claimers(app):
+    """Claimers in several processes never print a job twice"""
+    claimers, jobs = 4, 60
+    for i in range(jobs):
+        PrintJob(order=i + 1).save()
+
+    # Workers need their own copy of the app context, so they have to be forked
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_claim_worker, args=(app, f'worker-{i}', 0.1, results)) for i in range(claimers)]
+    for p in procs:
+        p.start()
+    printed = []
+    for p in procs:
+        printed.extend(results.get(timeout=60))
+    for p in procs:
+        p.join()
+
+    assert sorted(printed) == list(range(1, jobs + 1))
+
+
+def test_claim_order(app):
+    for order, printer in enumerate(['a', None, 'b', 'a', None, 'a'], 1):
+        PrintJob.enqueue(order, printer=printer)
+
+    # A job whose lease has run out goes back at its place, ahead of newer jobs
+    assert [job.order for job in PrintJob.claim_many('w1', 1, printer='a', lease=0)] == [1]
+    first = PrintJob.claim_many('w2', 3, printer='a')
+    assert [job.order for job in first] == [1, 2, 4]
+    assert [job.order for job in PrintJob.claim_many('w3', 10, printer='a')] == [5, 6]
+    assert PrintJob.claim_many('w3', 10, printer='a') == []
+
+    assert PrintJob.release(first[1].doc_id, 'w2')
+    PrintJob.enqueue(7, printer='a')
+    assert [job.order for job in PrintJob.claim_many('w4', 10)] == [2, 3, 7]
+
+
+def test_claim_drops_stale_jobs(app):
+    for order in range(1, 6):
+        PrintJob.enqueue(order)
+    now = time.time()
+    stale = {job.doc_id: {'created': now - 60} for job in PrintJob.all() if job.order in (1, 2, 4)}
+    PrintJob.bulk_update(stale)
+
+    assert [job.order for job in PrintJob.claim_many('w1', 2, max_age=10)] == [3, 5]
+    assert sorted(job.order for job in PrintJob.all()) == [3, 5]
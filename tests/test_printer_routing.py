@@ -0,0 +1,97 @@
+import pytest
+
+from app.database import Event, Order, PrintJob
+from app.lib.printer import route_order
+
+
+@pytest.fixture
+def make_routing_app(make_app):
+    """An app with ``printers`` configured, ready to route orders in"""
+    contexts = []
+
+    def _make(printers, **config):
+        app = make_app(PRINTERS=printers, **config)
+        ctx = app.app_context()
+        ctx.push()
+        contexts.append(ctx)
+        return app
+    yield _make
+    for ctx in contexts:
+        ctx.pop()
+
+
+def _event(name):
+    event = Event(name=name)
+    event.save()
+    return event.doc_id
+
+
+def _routed(order):
+    return route_order(order)['name']
+
+
+def test_single_printer(make_routing_app):
+    make_routing_app([{'name': 'bar', 'drink_types': ['menu']}])
+    # The only printer takes everything, whatever its rules
+    assert _routed(Order(drink=None)) == 'bar'
+
+
+def test_event_and_drink_type_rules(make_routing_app):
+    make_routing_app([
+        {'name': 'bar', 'drink_types': ['menu']},
+        {'name': 'party', 'events': ['Party'], 'drink_types': ['custom']},
+    ])
+    party = _event('Party')
+    other = _event('Other')
+
+    assert _routed(Order(event=party, drink=1)) == 'bar'
+    assert _routed(Order(event=other, drink=1)) == 'bar'
+    assert _routed(Order(drink=1)) == 'bar'
+    assert _routed(Order(event=party, drink=None)) == 'party'
+
+
+def test_no_matching_printer_falls_back_to_all(make_routing_app):
+    make_routing_app([
+        {'name': 'bar', 'drink_types': ['menu']},
+        {'name': 'party', 'events': ['Party'], 'drink_types': ['custom']},
+    ])
+    other = _event('Other')
+    PrintJob.enqueue(1, printer='bar')
+
+    # A custom drink at another event matches neither, so it goes to
+    # whichever printer is least busy, even one whose rules don't match
+    assert _routed(Order(event=other, drink=None)) == 'party'
+
+
+def test_least_busy(make_routing_app):
+    make_routing_app([{'name': 'a'}, {'name': 'b'}])
+    # A claimed job counts until its lease runs out
+    PrintJob.enqueue(1, printer='a')
+    PrintJob.claim('w1', printer='a', lease=60)
+    assert _routed(Order(drink=1)) == 'b'
+
+    # An expired lease doesn't
+    PrintJob.enqueue(2, printer='b')
+    PrintJob.claim('w1', printer='b', lease=-1)
+    assert _routed(Order(drink=1)) == 'b'
+
+    PrintJob.enqueue(3, printer='b')
+    PrintJob.enqueue(4, printer='b')
+    assert _routed(Order(drink=1)) == 'a'
+
+
+def test_round_robin(make_routing_app):
+    make_routing_app([
+        {'name': 'a', 'drink_types': ['menu']},
+        {'name': 'b', 'drink_types': ['menu']},
+        {'name': 'c', 'drink_types': ['menu']},
+        {'name': 'custom', 'drink_types': ['custom']},
+    ], PRINTER_ROUTING='round-robin')
+    # Busy printers are still taken in turn
+    PrintJob.enqueue(1, printer='a')
+
+    routed = [_routed(Order(drink=1)) for _ in range(6)]
+    assert sorted(routed[:3]) == ['a', 'b', 'c']
+    assert routed[3:] == routed[:3]
+    # With only one candidate there's no turn to take
+    assert [_routed(Order(drink=None)) for _ in range(2)] == ['custom', 'custom']
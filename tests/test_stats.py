@@ -0,0 +1,46 @@
+from app.database import ComponentStatRollup, Counter, DrinkComponent, Event, Order, OrderStat, OrderStatRollup
+
+
+def test_check_counters_on_empty_database(app):
+    res = app.test_cli_runner().invoke(args=['db', 'check-counters'])
+    assert res.exit_code == 0, res.output
+    assert "Order counters are correct" in res.output
+
+
+def test_check_counters(app):
+    event = Event(name='Party', is_current=True)
+    event.save()
+    for drink in (1, 1, 2):
+        OrderStat.from_order(Order(event=event.doc_id, drink=drink))
+    runner = app.test_cli_runner()
+    assert runner.invoke(args=['db', 'check-counters']).exit_code == 0
+
+    Counter.set_value(OrderStat.COUNTER_ALL, 5)
+    res = runner.invoke(args=['db', 'check-counters'])
+    assert res.exit_code != 0
+    assert f"{OrderStat.COUNTER_ALL}: counter is 5, 3 order stats" in res.output
+    assert runner.invoke(args=['db', 'check-counters', '--fix']).exit_code == 0
+    assert Counter.get_value(OrderStat.COUNTER_ALL) == 3
+
+
+def test_stats_page_reads_component_counts_from_the_rollup(app, monkeypatch):
+    event = Event(name='Party', is_current=True)
+    event.save()
+    lime, mint = DrinkComponent(name='Lime'), DrinkComponent(name='Mint')
+    lime.save()
+    mint.save()
+    for components in ([lime.doc_id], [lime.doc_id, mint.doc_id]):
+        OrderStat.from_order(Order(event=event.doc_id, drink_components=components))
+    assert {(s.component, s.count) for s in ComponentStatRollup.all()} == {(lime.doc_id, 2), (mint.doc_id, 1)}
+    rollup = [(s.event, s.component, s.count) for s in ComponentStatRollup.all()]
+    OrderStatRollup.rebuild()
+    assert sorted((s.event, s.component, s.count) for s in ComponentStatRollup.all()) == sorted(rollup)
+
+    def _no_raw_stats(*args, **kwargs):
+        raise AssertionError("The stats page read the raw stats")
+    monkeypatch.setattr(OrderStat, 'iter_raw', _no_raw_stats)
+    monkeypatch.setattr(OrderStat, 'all', _no_raw_stats)
+    res = app.test_client().get(f'/admin/stats?event={event.doc_id}')
+    assert res.status_code == 200
+    html = res.get_data(as_text=True)
+    assert 'Lime' in html and 'Mint' in html
@@ -0,0 +1,65 @@
+import multiprocessing
+import os
+
+import pytest
+
+from app.storage import BACKENDS, get_backend_class
+from app.storage.tinydb_backend import TinyDBBackend
+
+
+def _stress_worker(backend_name, filename, writes):
+    backend = get_backend_class(backend_name)(filename)
+    try:
+        counter = backend.table('StressCounter')
+        rows = backend.table('StressRow')
+        for i in range(writes):
+            with backend.transaction():
+                doc = counter.get(1)
+                counter.update({'value': doc['value'] + 1}, 1)
+            rows.insert({'pid': os.getpid(), 'i': i})
+    finally:
+        backend.close()
+
+
+def test_concurrent_writers(tmp_path, backend_name):
+    """Writers in several processes don't lose each other's updates"""
+    processes, writes = 4, 50
+    filename = str(tmp_path / BACKENDS[backend_name][2])
+    backend = get_backend_class(backend_name)(filename)
+    backend.table('StressCounter').insert({'value': 0})
+    backend.close()
+
+    procs = [multiprocessing.Process(target=_stress_worker, args=(backend_name, filename, writes)) for _ in range(processes)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    assert not any(p.exitcode for p in procs)
+
+    backend = get_backend_class(backend_name)(filename)
+    try:
+        assert backend.table('StressCounter').get(1)['value'] == processes * writes
+        rows = set((r['pid'], r['i']) for r in backend.table('StressRow').all())
+        assert len(rows) == processes * writes
+    finally:
+        backend.close()
+
+
+def test_json_reads_dont_see_uncommitted_writes(tmp_path):
+    backend = TinyDBBackend(str(tmp_path / 'db.json'))
+    table = backend.table('Item')
+    table.insert({'value': 0})
+    # What another thread might still be going through
+    data = backend.db.storage.read()
+
+    with pytest.raises(RuntimeError):
+        with backend.transaction():
+            table.update({'value': 1}, 1)
+            assert data['Item']['1']['value'] == 0
+            raise RuntimeError()
+    assert table.get(1)['value'] == 0
+
+    with backend.transaction():
+        table.update({'value': 2}, 1)
+    assert data['Item']['1']['value'] == 0
+    assert table.get(1)['value'] == 2